@@ -22,10 +22,11 @@ import time
 import shutil
 import string
 import random
-import hashlib
 import datetime
 import subprocess
 import urllib.parse
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
 from html import unescape
 from pathlib import Path
 from typing import List, Tuple, Dict, Optional
@@ -37,6 +38,8 @@ import psycopg2
 import requests
 import threading
 
+from my_celery.classes.video_utils import VideoReProcess
+
 # --- Database connection ---
 con = psycopg2.connect(
     database="time_traveler", user="postgres", password="m06Ar14u",
@@ -105,16 +108,34 @@ def run_ffmpeg_silencedetect(video_path: str) -> List[Tuple[float, float]]:
 def merge_segments(black: List[Tuple[float, float]], silence: List[Tuple[float, float]], tolerance: float = 1.0) -> List[Tuple[float, float]]:
     """
     Merge black and silent segments into a list of candidate commercial breaks.
+
+    Silences are sorted once and each black segment is only checked against the
+    silences whose window can reach it, emitting one candidate per black segment.
     """
+    if not black or not silence:
+        return []
+    silence = sorted(silence)
+    starts = [s_start for s_start, _ in silence]
+    reach = list(accumulate((s_end for _, s_end in silence), max))
+    pad = tolerance + 1e-6
+
     commercials = []
     for b_start, b_end in black:
-        for s_start, s_end in silence:
+        lo = bisect_left(reach, b_start - pad)
+        hi = bisect_right(starts, b_end + pad)
+        hull = None
+        for s_start, s_end in silence[lo:hi]:
             latest_start = max(b_start, s_start)
             earliest_end = min(b_end, s_end)
             overlap = earliest_end - latest_start
 
             if overlap >= 0 or abs(b_end - s_start) <= tolerance or abs(s_end - b_start) <= tolerance:
-                commercials.append((min(b_start, s_start), max(b_end, s_end)))
+                if hull is None:
+                    hull = (min(b_start, s_start), max(b_end, s_end))
+                else:
+                    hull = (min(hull[0], s_start), max(hull[1], s_end))
+        if hull is not None:
+            commercials.append(hull)
     return merge_close_segments(commercials)
 
 
@@ -196,12 +217,13 @@ def crop_to_43(input_file: str) -> str:
     filename = str(file.with_suffix(''))
     parent_path = Path(input_file).parent
     output_file = f"{parent_path}/{filename}.build.mp4"
+    loudness = VideoReProcess.measure_loudnorm(input_file)
 
     process_cmd = [
         'ffmpeg', '-y', '-loglevel', 'quiet', '-i', input_file,
         '-r', '30',
         '-vf', 'crop=ih*4/3:ih:(iw-ih*4/3)/2:0,scale=640:480',
-        '-af', 'loudnorm=I=-26:TP=-2:LRA=7',
+        '-af', VideoReProcess.loudnorm_filter(loudness),
         '-b:v', '800k',
         '-c:v', 'h264_videotoolbox',
         '-c:a', 'aac',
@@ -221,26 +243,16 @@ def process_remove_bars(input_file: str) -> Optional[str]:
         file = Path(os.path.basename(a.path))
         filename = str(file.with_suffix(''))
         parent_path = Path(input_file).parent
-        cropdetect_cmd = ['ffmpeg', '-i', input_file, '-vf', 'cropdetect', '-f', 'null', '-']
-        result = subprocess.run(cropdetect_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-        counter = {}
-        for line in result.stderr.splitlines():
-            match = re.search(r'crop=(\d+:\d+:\d+:\d+)', line)
-            if match:
-                crop_str = match.group(1)
-                hash_str = hashlib.md5(crop_str.encode()).hexdigest()
-                counter[hash_str] = counter.get(hash_str, []) + [crop_str]
-
-        largest_list_key = max(counter, key=lambda k: len(counter[k]))
-        crop_values = counter[largest_list_key].pop()
+        crop_values, _, loudness = VideoReProcess.detect_crop(input_file, measure_loudness=True)
+        if not crop_values:
+            raise RuntimeError("No crop values detected.")
 
         output_file = f"{parent_path}/{filename}.build.mp4"
         crop_cmd = [
             'ffmpeg', '-y', '-loglevel', 'quiet', '-i', input_file,
             '-r', '30',
             '-vf', f'crop={crop_values},scale=640:480,setdar=4/3',
-            '-af', 'loudnorm=I=-26:TP=-2:LRA=7',
+            '-af', VideoReProcess.loudnorm_filter(loudness),
             '-b:v', '800k',
             '-c:v', 'h264_videotoolbox',
             '-c:a', 'aac',
@@ -0,0 +1,203 @@
+"""
+Library-wide analysis backfill.
+
+Finds episodes, movies and specials with no probe data (end_point), no is_bw, and
+episodes break detection never ran on (breaks_scanned_at, see
+migrations/002_breaks_scanned.sql), then:
+
+  * probes missing lengths locally and writes them with one UPDATE per table,
+  * enqueues is_blackwhite / commercial_breaks in Celery groups of --batch-size,
+    keeping at most --max-in-flight tasks outstanding,
+  * writes each finished group back with one multi-row UPDATE/INSERT
+    (IsBlackWhite.insert_bw_bulk, CommercialBreaks.insert_commercial_breaks_bulk).
+
+Tasks are sent with dev_mode=True so workers never write row by row, and at
+PRIORITY_BACKFILL so ingestion and interactive checks on the same queues go first.
+Break detection is episodes only: commercial_breaks.media_id holds episode ids.
+"""
+
+import argparse
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from celery import group
+from dotenv import load_dotenv
+from psycopg2.extras import RealDictCursor, execute_values
+
+from celery_app import PRIORITY_BACKFILL
+from celery_tasks import is_blackwhite, commercial_breaks
+from classes.db_pool import db_connection
+from classes.video_utils import VideoReProcess, IsBlackWhite, CommercialBreaks
+
+load_dotenv()
+ROOT_DIR = os.getenv("DIR_ROOT_PI")
+
+db_config = {
+    'dbname': os.getenv("DB_NAME"),
+    'user': os.getenv("DB_USER"),
+    'password': os.getenv("DB_PASSWORD"),
+    'host': os.getenv("DB_HOST"),
+    'port': os.getenv("DB_PORT"),
+}
+
+MEDIA = {
+    "episodes": {"id": "episode_id", "file": "episode_file", "date": "episode_airdate", "show": "show_id"},
+    "movies": {"id": "movie_id", "file": "movie_file", "date": "movie_release_date", "show": None},
+    "specials": {"id": "special_id", "file": "specials_file", "date": "specials_airdate", "show": None},
+}
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Backfill is_bw, commercial breaks and probe data.")
+    parser.add_argument('--media', nargs='+', default=list(MEDIA), choices=list(MEDIA),
+                        help='Tables to backfill.')
+    parser.add_argument('--steps', nargs='+', default=['probe', 'bw', 'breaks'], choices=['probe', 'bw', 'breaks'],
+                        help='Analyses to backfill.')
+    parser.add_argument('--batch-size', type=int, default=50, help='Tasks per Celery group / DB write.')
+    parser.add_argument('--max-in-flight', type=int, default=200, help='Max outstanding tasks.')
+    parser.add_argument('--probe-workers', type=int, default=8, help='Local threads for probing lengths.')
+    parser.add_argument('--poll-interval', type=float, default=5.0, help='Seconds between result polls.')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what is missing.')
+    return parser.parse_args()
+
+
+def get_db_rows(query: str) -> list[dict]:
+    with db_connection(db_config) as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(query)
+        rows = cur.fetchall()
+        cur.close()
+    return rows
+
+
+def get_file_path(kind: str, row: dict) -> str:
+    date = row['media_date']
+    if kind == "episodes":
+        year = int(date.strftime("%y"))
+        return f'{ROOT_DIR}/{(year // 10) % 10}0s/{year}/{row["media_file"]}'
+    year = int(str(date)[:4]) % 100
+    return f'{ROOT_DIR}/{year // 10}0s/{kind}/{row["media_file"]}'
+
+
+def get_missing(kind: str, where: str) -> list[dict]:
+    """Rows of `kind` matching `where` (aliased as m), with a resolved file path."""
+    cols = MEDIA[kind]
+    show = f"m.{cols['show']}" if cols['show'] else "NULL"
+    query = f"""SELECT m.{cols['id']} AS media_id, m.{cols['file']} AS media_file, m.{cols['date']} AS media_date,
+                       {show} AS show_id, m.start_point, m.end_point
+                FROM {kind} m WHERE {where} ORDER BY m.{cols['id']};"""
+    rows = get_db_rows(query)
+    for row in rows:
+        row['path'] = get_file_path(kind, row)
+    return rows
+
+
+def update_end_points(kind: str, lengths: list[tuple[int, int]]) -> None:
+    """One multi-row UPDATE of end_point (and episode_durations for episodes)."""
+    tables = [(kind, MEDIA[kind]['id'])] + ([("episode_durations", "episode_id")] if kind == "episodes" else [])
+    with db_connection(db_config) as conn:
+        cur = conn.cursor()
+        for table, id_column in tables:
+            execute_values(cur, f"""UPDATE {table} AS t SET end_point = v.end_point
+                                    FROM (VALUES %s) AS v(media_id, end_point)
+                                    WHERE t.{id_column} = v.media_id;""", lengths, page_size=len(lengths))
+        cur.close()
+
+
+def backfill_probe(kind: str, rows: list[dict], workers: int) -> None:
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        lengths = list(pool.map(VideoReProcess.get_video_length, [row['path'] for row in rows]))
+    found = [(row['media_id'], int(length)) for row, length in zip(rows, lengths) if length]
+    if found:
+        update_end_points(kind, found)
+    print(f"[{kind}] probed {len(found)}/{len(rows)}")
+
+
+def run_batches(rows: list[dict], make_signature, write_batch, batch_size: int, max_in_flight: int,
+                poll_interval: float) -> None:
+    """
+    Send `rows` as Celery groups of `batch_size`, with at most `max_in_flight` tasks
+    outstanding, and hand each group's results to `write_batch` as soon as it finishes.
+    """
+    pending = deque(rows[i:i + batch_size] for i in range(0, len(rows), batch_size))
+    in_flight = []
+    done_count = 0
+
+    while pending or in_flight:
+        while pending and (not in_flight or (len(in_flight) + 1) * batch_size <= max_in_flight):
+            batch = pending.popleft()
+            in_flight.append((group(make_signature(row) for row in batch).apply_async(priority=PRIORITY_BACKFILL), batch))
+
+        finished = [entry for entry in in_flight if entry[0].ready()]
+        if not finished:
+            time.sleep(poll_interval)
+            continue
+
+        for entry in finished:
+            in_flight.remove(entry)
+            group_result, batch = entry
+            results = group_result.get(propagate=False)
+            write_batch(batch, [result if isinstance(result, dict) else {"success": False, "error": str(result)}
+                                for result in results])
+            group_result.forget()
+            done_count += len(batch)
+            print(f"{done_count}/{len(rows)} done")
+
+
+def backfill_bw(kind: str, rows: list[dict], args: argparse.Namespace) -> None:
+    def write_batch(batch: list[dict], results: list[dict]) -> None:
+        found = [(row['media_id'], result['is_bw']) for row, result in zip(batch, results) if result.get('success')]
+        IsBlackWhite.insert_bw_bulk(found, table=kind, id_column=MEDIA[kind]['id'], db_config=db_config)
+        for row, result in zip(batch, results):
+            if not result.get('success'):
+                print(f"[{kind} {row['media_id']}] {result.get('error')}")
+
+    run_batches(rows, lambda row: is_blackwhite.s(row['path'], row['media_id'], True), write_batch,
+                args.batch_size, args.max_in_flight, args.poll_interval)
+
+
+def backfill_breaks(rows: list[dict], args: argparse.Namespace) -> None:
+    def write_batch(batch: list[dict], results: list[dict]) -> None:
+        found = {row['media_id']: result['breaks'] for row, result in zip(batch, results) if result.get('success')}
+        CommercialBreaks.insert_commercial_breaks_bulk(found, db_config=db_config)
+        for row, result in zip(batch, results):
+            if not result.get('success'):
+                print(f"[episodes {row['media_id']}] {result.get('error')}")
+
+    def make_signature(row: dict):
+        return commercial_breaks.s(row['path'], row['media_id'], float(row['start_point'] or 0),
+                                   float(row['end_point']), True, show_id=row['show_id'])
+
+    run_batches(rows, make_signature, write_batch, args.batch_size, args.max_in_flight, args.poll_interval)
+
+
+def main() -> None:
+    args = parse_arguments()
+
+    # Probe first: break detection needs end_point
+    if 'probe' in args.steps:
+        for kind in args.media:
+            rows = get_missing(kind, "m.end_point IS NULL OR m.end_point = 0")
+            print(f"[{kind}] missing probe data: {len(rows)}")
+            if rows and not args.dry_run:
+                backfill_probe(kind, rows, args.probe_workers)
+
+    if 'bw' in args.steps:
+        for kind in args.media:
+            rows = get_missing(kind, "m.is_bw IS NULL")
+            print(f"[{kind}] missing is_bw: {len(rows)}")
+            if rows and not args.dry_run:
+                backfill_bw(kind, rows, args)
+
+    if 'breaks' in args.steps and 'episodes' in args.media:
+        # Scanned episodes with no breaks have no commercial_breaks rows, hence the flag
+        rows = get_missing("episodes", "m.end_point > 0 AND m.breaks_scanned_at IS NULL")
+        print(f"[episodes] missing commercial breaks: {len(rows)}")
+        if rows and not args.dry_run:
+            backfill_breaks(rows, args)
+
+
+if __name__ == "__main__":
+    main()
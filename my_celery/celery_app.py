@@ -1,4 +1,6 @@
 from celery import Celery
+from celery.signals import celeryd_init
+from kombu import Queue
 
 celery_app = Celery(
     "video_tasks",
@@ -6,20 +8,80 @@ celery_app = Celery(
     backend="redis://192.168.1.201:6379/1",
 )
 
-celery_app.conf.task_routes = {
-    "celery_tasks.process_video": {"queue": "video_queue"},
-    "celery_tasks.commercial_breaks": {"queue": "video_queue"},
-    "celery_tasks.is_blackwhite": {"queue": "video_queue"},
+# One queue per cost class, each served by its own worker so a quick B&W check
+# never waits behind an hour-long transcode:
+#   celery -A celery_app worker -Q video_heavy  -n heavy@%h
+#   celery -A celery_app worker -Q video_medium -n medium@%h
+#   celery -A celery_app worker -Q video_light  -n light@%h
+# A worker consuming exactly one of these picks up its concurrency and prefetch
+# below (see apply_queue_profile); -c / --prefetch-multiplier still override.
+HEAVY_QUEUE = "video_heavy"
+MEDIUM_QUEUE = "video_medium"
+LIGHT_QUEUE = "video_light"
+
+QUEUE_PROFILES = {
+    # Encodes use every core via chunked ffmpeg; prefetch 1 so queued work stays claimable by other hosts
+    HEAVY_QUEUE: {"concurrency": 1, "prefetch_multiplier": 1, "time_limit": 7200, "soft_time_limit": 7000},
+    # Full-file analysis decodes: a few at a time, still one reserved task per slot
+    MEDIUM_QUEUE: {"concurrency": 4, "prefetch_multiplier": 1, "time_limit": 3600, "soft_time_limit": 3400},
+    # Sampled probes and DB writes: many short tasks, prefetch to hide broker round trips
+    LIGHT_QUEUE: {"concurrency": 8, "prefetch_multiplier": 4, "time_limit": 600, "soft_time_limit": 540},
+}
+
+TASK_QUEUES = {
+    "celery_tasks.process_video": HEAVY_QUEUE,
+    "celery_tasks.commercial_breaks": MEDIUM_QUEUE,
+    "celery_tasks.analyze_video": MEDIUM_QUEUE,
+    "celery_tasks.is_blackwhite": LIGHT_QUEUE,
+}
+
+# Redis priorities: 0 is served first. Pass priority= to apply_async to override the default.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 5
+PRIORITY_BACKFILL = 9
+
+celery_app.conf.task_queues = [Queue(name) for name in QUEUE_PROFILES]
+celery_app.conf.task_default_queue = LIGHT_QUEUE
+celery_app.conf.task_routes = {task: {"queue": queue} for task, queue in TASK_QUEUES.items()}
+celery_app.conf.task_annotations = {
+    task: {"time_limit": QUEUE_PROFILES[queue]["time_limit"],
+           "soft_time_limit": QUEUE_PROFILES[queue]["soft_time_limit"]}
+    for task, queue in TASK_QUEUES.items()
 }
 
+# Unacked tasks are redelivered after this long, so it must outlast the longest task (heavy)
+# plus its wait in the worker's prefetch buffer, or acks_late runs it twice
+VISIBILITY_TIMEOUT = max(profile["time_limit"] for profile in QUEUE_PROFILES.values()) + 3600
+
 celery_app.conf.update(
     broker_transport_options={
-        "visibility_timeout": 7200
+        "visibility_timeout": VISIBILITY_TIMEOUT,
+        "queue_order_strategy": "priority",
+        "priority_steps": list(range(10)),
+        "sep": ":",
     },
+    task_default_priority=PRIORITY_DEFAULT,
     task_acks_late=True,
     task_reject_on_worker_lost=True,
     task_time_limit=7200,
     task_soft_time_limit=7000,
 )
 
+
+@celeryd_init.connect
+def apply_queue_profile(conf=None, options=None, **kwargs) -> None:
+    """Worker defaults for the single queue it was started on (-Q); mixed workers keep the global ones."""
+    options = options or {}
+    queues = options.get("queues") or []
+    if isinstance(queues, str):
+        queues = queues.split(",")
+    if len(queues) == 1 and queues[0] in QUEUE_PROFILES:
+        profile = QUEUE_PROFILES[queues[0]]
+        conf.worker_concurrency = profile["concurrency"]
+        conf.worker_prefetch_multiplier = profile["prefetch_multiplier"]
+    # -c wins over the profile; mirror it so tasks size their ffmpeg fan-out by it (cores_per_task)
+    if options.get("concurrency"):
+        conf.worker_concurrency = options["concurrency"]
+
+
 import celery_tasks
@@ -1,9 +1,14 @@
 import json
 import os
+import select
 import time
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from celery.celery_tasks import process_video
+from celery import states
+from celery.result import AsyncResult
+from celery_app import celery_app, HEAVY_QUEUE, PRIORITY_DEFAULT
+from celery_tasks import process_video, episode_metadata, TaskDedup
+from classes.db_pool import db_connection
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,28 +22,33 @@ db_config = {
     'port': os.getenv("DB_PORT"),
 }
 
+# Schema (heartbeat_at, celery_id, NOTIFY trigger) comes from migrations/001_ingestion_intake.sql
+NOTIFY_CHANNEL = "ingestion_tasks"
+# Claimed rows are heartbeated by the intake tracking them; rows silent for HEARTBEAT_TIMEOUT are reclaimed,
+# and re-attached to their Celery task if it was picked up, instead of being submitted again
+HEARTBEAT_INTERVAL = 60
+HEARTBEAT_TIMEOUT = int(os.getenv("INGESTION_HEARTBEAT_TIMEOUT", 300))
+# Max jobs in flight per intake on top of the cluster-wide limit; 0 for no per-intake cap
+MAX_IN_FLIGHT = int(os.getenv("INGESTION_MAX_IN_FLIGHT", 0))
+
 
 def update_task_status(update_list: list, status: str = 'working', message=None) -> None:
     if message is None:
         message = {}
     # query = f"""UPDATE video_tasks SET status = %s, message = %s WHERE episode_id = ANY(%s)"""
     query = f"""UPDATE ingestion_tasks SET status = %s, message = %s WHERE task_id = ANY(%s::int[])"""
-    conn = psycopg2.connect(**db_config)
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute(query, (status, json.dumps(message), update_list))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-
-def get_db_rows(query: str) -> list[dict]:
-    conn = psycopg2.connect(**db_config)
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute(query)
-    rows = cur.fetchall()
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db_connection(db_config) as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(query, (status, json.dumps(message), update_list))
+        cur.close()
+
+
+def get_db_rows(query: str, params: tuple = None) -> list[dict]:
+    with db_connection(db_config) as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        cur.close()
 
     return rows
 
@@ -49,25 +59,42 @@ def get_file_path(airdate, episode_file):
     return f'{ROOT_DIR}/{decade}/{year}/{episode_file}'
 
 
-def get_video_jobs():
+def get_video_jobs(limit: int):
+    """
+    Claim at most `limit` jobs: pending rows, plus working rows whose heartbeat
+    expired (their intake died). SKIP LOCKED lets several intakes claim side by side.
+    Rows claimed before heartbeats existed (heartbeat_at NULL) are never reclaimed:
+    nothing says whether their task is still running, so they are left for an operator.
+
+    Returns (task_id, episode_data, celery_id) tuples; celery_id is the task a
+    reclaimed row was submitted as, None for pending rows.
+    """
+    if limit <= 0:
+        return []
     try:
         query = """
-        UPDATE ingestion_tasks
-        SET status = 'working'
-        WHERE task_id IN (
-            SELECT task_id
+        WITH claimed AS (
+            SELECT task_id, status AS previous_status, celery_id
             FROM ingestion_tasks
             WHERE status = 'pending'
+               OR (status = 'working'
+                   AND heartbeat_at < now() - %s * interval '1 second')
             ORDER BY task_id
+            LIMIT %s
             FOR UPDATE SKIP LOCKED
         )
-        RETURNING task_id, episode_data
+        UPDATE ingestion_tasks t
+        SET status = 'working', heartbeat_at = now()
+        FROM claimed c
+        WHERE t.task_id = c.task_id
+        RETURNING t.task_id, t.episode_data,
+                  CASE WHEN c.previous_status = 'working' THEN c.celery_id END AS celery_id
         """
 
-        rows = get_db_rows(query)
+        rows = get_db_rows(query, (HEARTBEAT_TIMEOUT, limit))
 
         return [
-            (row['task_id'], row['episode_data'])
+            (row['task_id'], row['episode_data'], row['celery_id'])
             for row in rows
         ]
 
@@ -75,6 +102,93 @@ def get_video_jobs():
         print(f"Database query failed: {e}")
         return []
 
+def set_celery_ids(celery_ids: dict[int, str]) -> None:
+    """Record the Celery task each row was submitted as, so a reclaiming intake can find it."""
+    if not celery_ids:
+        return
+    try:
+        with db_connection(db_config) as conn:
+            cur = conn.cursor()
+            cur.executemany("UPDATE ingestion_tasks SET celery_id = %s WHERE task_id = %s",
+                            [(celery_id, task_id) for task_id, celery_id in celery_ids.items()])
+            cur.close()
+    except Exception as e:
+        print(f"Recording Celery ids failed: {e}")
+
+
+def heartbeat(task_ids: list) -> None:
+    """Mark the rows this intake is tracking as alive."""
+    if not task_ids:
+        return
+    try:
+        with db_connection(db_config) as conn:
+            cur = conn.cursor()
+            cur.execute("UPDATE ingestion_tasks SET heartbeat_at = now() WHERE task_id = ANY(%s::int[])", (task_ids,))
+            cur.close()
+    except Exception as e:
+        print(f"Heartbeat failed: {e}")
+
+
+def busy_rows() -> int:
+    """Rows some live intake is tracking, i.e. transcodes queued or running across the cluster."""
+    try:
+        rows = get_db_rows("""SELECT count(*) AS busy FROM ingestion_tasks
+                              WHERE status = 'working' AND heartbeat_at >= now() - %s * interval '1 second'""",
+                           (HEARTBEAT_TIMEOUT,))
+        return rows[0]['busy']
+    except Exception as e:
+        print(f"Database query failed: {e}")
+        return 0
+
+
+def free_slots(slots: int, in_flight: int) -> int:
+    """Jobs this intake may claim: encode slots not taken by any intake's rows, within MAX_IN_FLIGHT."""
+    free = slots - busy_rows()
+    if MAX_IN_FLIGHT:
+        free = min(free, MAX_IN_FLIGHT - in_flight)
+    return max(0, free)
+
+
+def worker_slots(default: int = 4) -> int:
+    """Total pool concurrency of the workers on the encode queue, or `default` if none answer."""
+    try:
+        inspect = celery_app.control.inspect(timeout=1.0)
+        stats = inspect.stats() or {}
+        active_queues = inspect.active_queues() or {}
+        # Only workers consuming the encode queue can take process_video
+        slots = sum(worker.get("pool", {}).get("max-concurrency", 0) for name, worker in stats.items()
+                    if any(queue["name"] == HEAVY_QUEUE for queue in active_queues.get(name, [])))
+        return slots or default
+    except Exception as e:
+        print(f"Worker stats unavailable: {e}")
+        return default
+
+
+def listen_for_jobs():
+    """Dedicated (unpooled) autocommit connection LISTENing for new jobs, or None (intake then just polls)."""
+    try:
+        conn = psycopg2.connect(**db_config)
+        conn.set_session(autocommit=True)
+        conn.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+        return conn
+    except Exception as e:
+        print(f"LISTEN failed, polling only: {e}")
+        return None
+
+
+def wait_for_jobs(conn, timeout: float) -> bool:
+    """Wait up to `timeout` seconds for a NOTIFY. Returns True if one arrived."""
+    if conn is None:
+        time.sleep(timeout)
+        return False
+    if select.select([conn], [], [], timeout) == ([], [], []):
+        return False
+    conn.poll()
+    notified = bool(conn.notifies)
+    conn.notifies.clear()
+    return notified
+
+
 def make_callback():
     def handle_progress(message):
         if message['status'] == "PROGRESS":
@@ -85,52 +199,105 @@ def make_callback():
     return handle_progress
 
 
-def main_loop(poll_interval=30):
-    """Continuously poll for new jobs and submit them to Celery."""
-    while True:
-        jobs = get_video_jobs()
-
-        if not jobs:
-            print("No new jobs, waiting...")
-            time.sleep(poll_interval)
+def record_finished(in_flight: dict) -> None:
+    """
+    Write the status of every finished task in `in_flight` and drop it from the dict.
+    Results are left to expire (result_expires) instead of being forgotten: through
+    TaskDedup, rows of other intakes may be attached to the same task.
+    """
+    for key, (task, video_path, task_id) in list(in_flight.items()):
+        if not task.ready():
             continue
+        del in_flight[key]
 
-        async_results = []
+        try:
+            result = task.get(timeout=0)
+            status = "complete" if result.get("success") else "error"
+            update_task_status(
+                [task_id],
+                status=status,
+                message=result
+            )
 
-        # Submit jobs
-        for task_id, episode_data in jobs:
-            episode_data = json.loads(episode_data)
-            print("Submitting:", episode_data["path"], task_id)
+            print(f"[{video_path}] Final:", result)
 
-            task = process_video.apply_async(
-                args=[task_id, episode_data]
+        except Exception as e:
+            update_task_status(
+                [task_id],
+                status="error",
+                message=str(e)
             )
+            print(f"[{video_path}] FAILED:", e)
+
+
+def main_loop(poll_interval=30, result_interval=1.0):
+    """
+    Continuously claim new jobs and submit them to Celery.
+
+    Intake wakes on a NOTIFY from ingestion_tasks (polling every `poll_interval`
+    seconds as a fallback) and whenever a task finishes, and only claims as many
+    jobs as there are free encode slots: heavy-queue concurrency minus the live
+    working rows of every intake, so several intakes can share the table.
+    Results are checked every `result_interval` seconds and each task's status is
+    written as soon as it finishes, so one long movie doesn't hold up the rest.
+    """
+    listen_conn = listen_for_jobs()
+    in_flight = {}
+    last_poll = None
+    last_heartbeat = time.monotonic()
+    slots = worker_slots()
+    freed = False
+
+    while True:
+        try:
+            notified = wait_for_jobs(listen_conn, result_interval)
+        except (psycopg2.Error, OSError) as e:
+            print(f"LISTEN connection lost, reconnecting: {e}")
+            listen_conn = listen_for_jobs()
+            notified = False
+
+        poll_due = last_poll is None or time.monotonic() - last_poll >= poll_interval
+        if poll_due:
+            last_poll = time.monotonic()
+            slots = worker_slots()
+
+        if notified or poll_due or freed:
+            jobs = get_video_jobs(free_slots(slots, len(in_flight)))
+
+            if not jobs and not in_flight:
+                print("No new jobs, waiting...")
+
+            # Submit jobs
+            submitted = {}
+            for task_id, episode_data, celery_id in jobs:
+                episode_data = json.loads(episode_data)
 
-            async_results.append((task, episode_data["path"], task_id))
+                # A reclaimed row whose task a worker already picked up (or finished) is just tracked again
+                previous = AsyncResult(celery_id, app=celery_app) if celery_id else None
+                if previous is not None and previous.state != states.PENDING:
+                    print("Reattaching:", episode_data["path"], task_id)
+                    in_flight[task_id] = (previous, episode_data["path"], task_id)
+                    continue
 
-        # Collect results
-        for task, video_path, task_id in async_results:
-            try:
-                result = task.get(timeout=None)  # optional timeout
-                status = "complete" if result.get("success") else "error"
-                update_task_status(
-                    [task_id],
-                    status=status,
-                    message=result
-                )
+                print("Submitting:", episode_data["path"], task_id)
+                # Attaches to an identical queued/running transcode, or returns its memoized result
+                task = TaskDedup.submit(process_video, episode_data["path"], episode_metadata(episode_data),
+                                        [task_id, episode_data], priority=PRIORITY_DEFAULT)
 
-                print(f"[{video_path}] Final:", result)
+                # Keyed by row: deduplicated rows can share one Celery task
+                in_flight[task_id] = (task, episode_data["path"], task_id)
+                submitted[task_id] = task.id
+            set_celery_ids(submitted)
 
-            except Exception as e:
-                update_task_status(
-                    [task_id],
-                    status="error",
-                    message=str(e)
-                )
-                print(f"[{video_path}] FAILED:", e)
+        if time.monotonic() - last_heartbeat >= HEARTBEAT_INTERVAL:
+            last_heartbeat = time.monotonic()
+            heartbeat([task_id for _, _, task_id in in_flight.values()])
 
-        time.sleep(poll_interval)
+        # Collect results; freed slots are refilled on the next pass
+        running = len(in_flight)
+        record_finished(in_flight)
+        freed = len(in_flight) < running
 
 
 if __name__ == "__main__":
-    main_loop(poll_interval=2)  # check DB every 2 min
+    main_loop(poll_interval=30)  # NOTIFY wakes intake; poll every 30s as a fallback
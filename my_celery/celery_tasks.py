@@ -1,69 +1,444 @@
+import hashlib
+import json
 import os
 import shutil
 import subprocess
+import threading
+import time
 from pathlib import Path
-from celery import shared_task
+from typing import Callable, Optional
+from celery import shared_task, states
+from celery.utils import uuid
+from celery.exceptions import Retry
+from celery.result import AsyncResult, EagerResult
+from celery.contrib.abortable import ABORTED, AbortableAsyncResult
+from celery.signals import (worker_ready, worker_process_init, worker_process_shutdown, task_prerun,
+                            task_postrun)
 from celery.utils.log import get_task_logger
+from celery.worker.state import revoked as revoked_tasks
 
-from celery_app import celery_app
-from classes.video_utils import VideoReProcess, CommercialBreaks, IsBlackWhite
+from celery_app import celery_app, VISIBILITY_TIMEOUT
+from classes.db_pool import init_pool, close_pools
+from classes.video_utils import VideoReProcess, CommercialBreaks, IsBlackWhite, ReprocessCheckpoint, AnalysisCache
+from classes.frame_analyzer import (FrameAnalysisPipeline, BlackFrameAnalyzer, BlackWhiteAnalyzer, CropAnalyzer,
+                                    SceneChangeAnalyzer, AudioLevelAnalyzer)
 
 logger = get_task_logger(__name__)
 
+# Max parallel ffmpeg shards for one long file; 0 uses the task's share of the cores (cores_per_task)
+DETECT_SHARDS = int(os.getenv("DETECT_SHARDS", 0))
+# Parallel chunk encoders for long files in reprocess; 1 encodes every file in one pass, 0 uses cores_per_task
+TRANSCODE_CHUNKS = int(os.getenv("TRANSCODE_CHUNKS", 0))
+# Extra age, past the visibility timeout, before a worker clears another task's reprocess checkpoint
+STALE_CHECKPOINT_MARGIN = 3600
+# Keep the original of every reprocessed file as OLD_<name>
+KEEP_BACKUPS = os.getenv("KEEP_BACKUPS", "true").lower() != "false"
+
+
+@worker_process_init.connect
+def open_db_pool(**kwargs) -> None:
+    """One connection pool per worker child, shared by every task it runs."""
+    init_pool()
+
+
+@worker_process_shutdown.connect
+def close_db_pool(**kwargs) -> None:
+    close_pools()
+
+
+@worker_ready.connect
+def clear_stale_checkpoints(**kwargs) -> None:
+    """Remove reprocess temp files left by tasks that died and were never retried."""
+    # A task lost with its host is only redelivered after the visibility timeout; until then
+    # (plus a margin for its wait in a queue) its checkpoint is what the redelivery resumes from
+    cleared = ReprocessCheckpoint.clear_stale(VISIBILITY_TIMEOUT + STALE_CHECKPOINT_MARGIN)
+    if cleared:
+        logger.info(f"Cleared {cleared} stale reprocess checkpoints")
+
+
+class FFmpegTaskHooks:
+    """
+    Progress and early-abort callbacks for FFmpegRunner inside a bound task.
+
+    Progress is pushed through `task.update_state` (throttled to one update every
+    `interval` seconds). `should_stop` trips when the task is stopped or when it
+    gets within `margin` seconds of its time limit, counted from when the task
+    started, so ffmpeg is stopped while there is still time to return partial results.
+
+    Under the prefork pool, revokes only reach the worker's main process, so a
+    running task is stopped through the result backend instead: stop_task() marks
+    it ABORTED (or a terminate revoke marks it REVOKED), and the state is checked
+    at most every `interval` seconds and before each progress update, which
+    would otherwise overwrite it.
+    """
+
+    def __init__(self, task, step: str, file: str, margin: float = 120, interval: float = 5.0) -> None:
+        self.task = task
+        self.step = step
+        self.file = file
+        self.interval = interval
+        self.reason = None
+        self._last_update = 0.0
+        self._last_check = 0.0
+
+        hard_limit, soft_limit = task.request.timelimit or (None, None)
+        limit = (soft_limit or task.soft_time_limit or celery_app.conf.task_soft_time_limit
+                 or hard_limit or task.time_limit or celery_app.conf.task_time_limit)
+        started = getattr(task.request, "started_at", None) or time.monotonic()
+        self.deadline = started + limit - margin if limit else None
+
+    def on_progress(self, progress: dict) -> None:
+        now = time.monotonic()
+        if self.task.request.id is None or now - self._last_update < self.interval:
+            return
+        self._last_update = now
+        if self.reason or self._stop_requested():
+            return
+        self.task.update_state(state="PROGRESS", meta={"step": self.step, "file": self.file, **progress})
+
+    def _stop_requested(self) -> bool:
+        self._last_check = time.monotonic()
+        try:
+            state = AsyncResult(self.task.request.id, app=celery_app).state
+        except Exception as e:
+            logger.warning(f"Task state unavailable: {e}")
+            return False
+        if state in (states.REVOKED, ABORTED):
+            self.reason = "revoked"
+        return self.reason is not None
+
+    def should_stop(self) -> bool:
+        task_id = self.task.request.id
+        if self.reason is not None:
+            return True
+        if task_id is not None and task_id in revoked_tasks:
+            # Only seen with the solo and thread pools
+            self.reason = "revoked"
+        elif task_id is not None and time.monotonic() - self._last_check >= self.interval:
+            self._stop_requested()
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.reason = "soft time limit"
+        return self.reason is not None
+
+
+def stop_task(task_id: str) -> None:
+    """Stop a task whether queued (revoke) or already running (ABORTED, seen by FFmpegTaskHooks)."""
+    celery_app.control.revoke(task_id)
+    AbortableAsyncResult(task_id, app=celery_app).abort()
+
+
+@task_prerun.connect
+def record_task_start(task=None, **kwargs) -> None:
+    # Time limits run from here, not from when a task builds its FFmpegTaskHooks
+    task.request.started_at = time.monotonic()
+
+
+class TaskDedup:
+    """
+    Redis lock and result memo keyed by (task name, file identity, params), so the
+    same work on the same file runs once however often it is submitted.
+
+    Worker side, `run_once` returns the memoized result if there is one; otherwise
+    it takes the lock (kept alive while the work runs, so a dead worker's lock
+    lapses within LOCK_TTL) and memoizes what `compute` returns. A copy that finds
+    the lock held - a redelivery under acks_late, or a second submission - retries
+    itself every RETRY_DELAY seconds until the memo appears, without holding a slot.
+
+    Submission side, `submit` returns the memoized result as an EagerResult, or the
+    AsyncResult of a run that is already queued or running, and only sends a new
+    task when there is neither. The queued marker is dropped when that task ends
+    (task_postrun), whichever path it returned by.
+
+    Params must cover everything that changes the result; DB writes stay outside
+    `compute` so they still happen (idempotently) on a memo hit. Redis errors, and
+    files that can't be read, disable dedup for that call rather than failing it.
+    """
+
+    LOCK_TTL = 300
+    RETRY_DELAY = 60
+    # A queued marker outlives any run and redelivery, so it only lapses for lost tasks
+    QUEUED_TTL = VISIBILITY_TIMEOUT
+    MEMO_TTL = int(os.getenv("TASK_MEMO_TTL", 30 * 86400))
+
+    @staticmethod
+    def key(task_name: str, file_path: str, params: dict) -> Optional[str]:
+        try:
+            identity = AnalysisCache.file_identity(file_path)
+        except OSError:
+            return None
+        params_hash = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+        return f"dedup:{task_name}:{identity}:{params_hash}"
+
+    @staticmethod
+    def cached(key: str):
+        try:
+            memo = celery_app.backend.client.get(f"{key}:memo")
+        except Exception as e:
+            logger.warning(f"Task memo unavailable: {e}")
+            return None
+        return json.loads(memo) if memo else None
+
+    @staticmethod
+    def remember(key: Optional[str], result) -> None:
+        if key is None:
+            return
+        try:
+            celery_app.backend.client.set(f"{key}:memo", json.dumps(result), ex=TaskDedup.MEMO_TTL)
+        except Exception as e:
+            logger.warning(f"Task memo not saved: {e}")
+
+    @staticmethod
+    def _keep_alive(lock, stop: threading.Event) -> None:
+        while not stop.wait(TaskDedup.LOCK_TTL / 3):
+            try:
+                lock.reacquire()
+            except Exception as e:
+                logger.warning(f"Task lock refresh failed: {e}")
+
+    @staticmethod
+    def run_once(task, file_path: str, params: dict, compute: Callable[[], dict], rekey: bool = False) -> dict:
+        """
+        compute() once per key. Results with success False aren't memoized. With
+        `rekey`, a successful result is also memoized under the file's identity after
+        compute(), for tasks that rewrite their input (a resubmission then hits it).
+        """
+        key = TaskDedup.key(task.name, file_path, params)
+        if key is None:
+            return compute()
+        cached = TaskDedup.cached(key)
+        if cached is not None:
+            return {**cached, "cached": True}
+
+        try:
+            lock = celery_app.backend.client.lock(f"{key}:lock", timeout=TaskDedup.LOCK_TTL)
+            acquired = lock.acquire(blocking=False, token=task.request.id or uuid())
+        except Exception as e:
+            logger.warning(f"Task lock unavailable, running unguarded: {e}")
+            return compute()
+        if not acquired:
+            raise task.retry(countdown=TaskDedup.RETRY_DELAY, max_retries=None)
+
+        stop = threading.Event()
+        threading.Thread(target=TaskDedup._keep_alive, args=(lock, stop), daemon=True).start()
+        try:
+            result = compute()
+            if result.get("success", True):
+                TaskDedup.remember(key, result)
+                if rekey:
+                    TaskDedup.remember(TaskDedup.key(task.name, file_path, params), result)
+            return result
+        finally:
+            stop.set()
+            try:
+                lock.release()
+            except Exception as e:
+                logger.error(f"Task lock release failed: {e}")
+
+    @staticmethod
+    def finish(task_id: str) -> None:
+        """Drop the queued marker `submit` set for `task_id`, if it still points at it."""
+        try:
+            client = celery_app.backend.client
+            key = client.get(f"dedup:submitted:{task_id}")
+            if key is None:
+                return
+            key = key.decode()
+            queued = client.get(f"{key}:queued")
+            if queued is not None and queued.decode() == task_id:
+                client.delete(f"{key}:queued")
+            client.delete(f"dedup:submitted:{task_id}")
+        except Exception as e:
+            logger.warning(f"Task queued marker not cleared: {e}")
+
+    @staticmethod
+    def submit(task, file_path: str, params: dict, args: list, **options):
+        """apply_async, unless the same work is memoized (EagerResult) or already queued (its AsyncResult)."""
+        key = TaskDedup.key(task.name, file_path, params)
+        if key is None:
+            return task.apply_async(args=args, **options)
+        cached = TaskDedup.cached(key)
+        if cached is not None:
+            return EagerResult(uuid(), {**cached, "cached": True}, states.SUCCESS)
+
+        task_id = uuid()
+        try:
+            client = celery_app.backend.client
+            if not client.set(f"{key}:queued", task_id, nx=True, ex=TaskDedup.QUEUED_TTL):
+                queued = client.get(f"{key}:queued")
+                if queued:
+                    return AsyncResult(queued.decode(), app=celery_app)
+            # Lets the task find its marker even if its file is gone or rewritten by then
+            client.set(f"dedup:submitted:{task_id}", key, ex=TaskDedup.QUEUED_TTL)
+        except Exception as e:
+            logger.warning(f"Task dedup unavailable: {e}")
+        return task.apply_async(args=args, task_id=task_id, **options)
+
+
+@task_postrun.connect
+def clear_queued_marker(task_id=None, state=None, **kwargs) -> None:
+    # A retrying task is still the run that duplicates attach to
+    if state != states.RETRY:
+        TaskDedup.finish(task_id)
+
+
+def cores_per_task() -> int:
+    """This host's cores shared across the worker's pool slots, so concurrent tasks don't oversubscribe them."""
+    cores = os.cpu_count() or 1
+    return max(1, cores // (celery_app.conf.worker_concurrency or cores))
+
+
+def episode_metadata(episode: dict) -> dict:
+    return {
+        "title": f"{episode['title']} - {episode['airdate']}",
+        "artist": episode["showName"],
+        "comment": "TV Party Tonight",
+        "year": str(episode['airdate'])
+    }
+
+
 @celery_app.task(bind=True, name="celery_tasks.is_blackwhite")
 def is_blackwhite(self, input_file: str, episode_id: int, dev_mode: bool = True) -> dict:
+    def detect() -> dict:
+        is_bw, confidence = IsBlackWhite.is_video_black_and_white(input_file)
+        if is_bw is None:
+            # Not memoized, so a fixed or replaced file is analysed again
+            return {"success": False, "error": "is_blackwhite found no usable frames"}
+        return {"is_bw": is_bw, "confidence": confidence}
+
     try:
-        is_bw = IsBlackWhite.is_video_black_and_white_opencv(input_file)
+        result = TaskDedup.run_once(self, input_file, {}, detect)
+        # is_bw None also covers verdicts memoized before the failure was reported as one
+        if result.get("success") is False or result.get("is_bw") is None:
+            return {"episode_id": episode_id, "success": False,
+                    "error": result.get("error", "is_blackwhite found no usable frames")}
         if not dev_mode:
-            IsBlackWhite.insert_bw(episode_id, is_bw)
-        return {"episode_id": episode_id, "success": True, "is_bw": is_bw}
+            IsBlackWhite.insert_bw(episode_id, result["is_bw"])
+        return {"episode_id": episode_id, "success": True, **result}
 
+    except Retry:
+        raise
     except Exception as e:
         return {"episode_id": episode_id, "success": False, "error": f"is_blackwhite failed {e}"}
 
 
 @celery_app.task(bind=True, name="celery_tasks.commercial_breaks")
 def commercial_breaks(self, input_file: str, episode_id: int, start_point: float, end_point: float,
-                      dev_mode: bool = True) -> dict:
-    try:
-        input_path = Path(input_file)
-        black = CommercialBreaks.run_ffmpeg_blackdetect(input_path)
-        silence = CommercialBreaks.run_ffmpeg_silencedetect(input_path)
+                      dev_mode: bool = True, shards: int | None = None, profile: str = "full",
+                      show_id: int | None = None, refine: bool = False) -> dict:
+    input_path = Path(input_file)
+    hooks = FFmpegTaskHooks(self, "detecting commercial breaks", input_file)
+
+    def detect() -> dict:
+        detected = None
+        if midpoints:
+            detected = CommercialBreaks.run_ffmpeg_detect_windowed(input_path, midpoints, profile=profile,
+                                                                   on_progress=hooks.on_progress,
+                                                                   should_stop=hooks.should_stop)
+        if detected is None and not hooks.reason:
+            detected = CommercialBreaks.run_ffmpeg_detect_sharded(input_path, shards or DETECT_SHARDS or cores_per_task(),
+                                                                  profile=profile, on_progress=hooks.on_progress,
+                                                                  should_stop=hooks.should_stop)
+        black, silence = detected or ([], [])
         candidates = CommercialBreaks.merge_segments(black, silence)
         candidates = CommercialBreaks.filter_edges(candidates, start_point, end_point)
-        if not dev_mode:
-            CommercialBreaks.insert_commercial_break(episode_id, candidates)
-        return {"episode_id": episode_id, "success": True}
+        if refine and not hooks.reason:
+            # Scan above can be a cheap profile (e.g. "coarse"); snap each break at full frame rate
+            candidates = CommercialBreaks.refine_breaks(input_path, candidates, should_stop=hooks.should_stop)
+        if hooks.reason:
+            # Partial scan: hand back what was found, but don't memoize or write it
+            return {"success": False, "error": f"commercial_breaks aborted: {hooks.reason}",
+                    "partial_breaks": candidates}
+        return {"success": True, "breaks": candidates}
+
+    try:
+        # Shows with enough detected episodes only need the windows around their usual breaks.
+        # The priors change what is scanned, so they are part of the dedup key.
+        midpoints = CommercialBreaks.get_break_priors(show_id) if show_id is not None else []
+        params = {"start_point": start_point, "end_point": end_point, "profile": profile, "refine": refine,
+                  "midpoints": midpoints}
+        result = TaskDedup.run_once(self, input_file, params, detect)
+        if result["success"] and not dev_mode:
+            CommercialBreaks.insert_commercial_break(episode_id, result["breaks"], precision=3 if refine else 2)
+        return {"episode_id": episode_id, **result}
 
+    except Retry:
+        raise
     except Exception as e:
         return {"episode_id": episode_id, "success": False, "error": "commercial_breaks failed"}
 
+@celery_app.task(bind=True, name="celery_tasks.analyze_video")
+def analyze_video(self, input_file: str, episode_id: int, start_point: float, end_point: float,
+                  dev_mode: bool = True) -> dict:
+    """Black/silence breaks, B&W, crop and scene cuts from a single decode."""
+    hooks = FFmpegTaskHooks(self, "analyzing video", input_file)
+
+    def analyze() -> dict:
+        pipeline = FrameAnalysisPipeline([
+            BlackFrameAnalyzer(), BlackWhiteAnalyzer(), CropAnalyzer(), SceneChangeAnalyzer(), AudioLevelAnalyzer(),
+        ])
+        results = pipeline.run(input_file, on_progress=hooks.on_progress, should_stop=hooks.should_stop)
+        if results is None:
+            error = f"analyze_video aborted: {hooks.reason}" if hooks.reason else "analyze_video failed"
+            return {"success": False, "error": error}
+
+        silence = CommercialBreaks.silence_from_levels(results["audio"]) if results["audio"] else []
+        breaks = CommercialBreaks.merge_segments(results["black"], silence)
+        breaks = CommercialBreaks.filter_edges(breaks, start_point, end_point)
+        bw = results["bw"]
+        return {
+            "success": True, "is_bw": bw["is_bw"], "bw_confidence": bw["confidence"],
+            "crop": results["crop"], "breaks": breaks, "scene_cuts": len(results["scenes"]),
+        }
+
+    try:
+        result = TaskDedup.run_once(self, input_file, {"start_point": start_point, "end_point": end_point}, analyze)
+        if result["success"] and not dev_mode:
+            if result["is_bw"] is not None:
+                IsBlackWhite.insert_bw(episode_id, result["is_bw"])
+            CommercialBreaks.insert_commercial_break(episode_id, result["breaks"])
+        return {"episode_id": episode_id, **result}
+
+    except Retry:
+        raise
+    except Exception as e:
+        return {"episode_id": episode_id, "success": False, "error": f"analyze_video failed {e}"}
+
+
 @celery_app.task(bind=True, name="celery_tasks.process_video")
 def process_video(self, task_id: int, episode: dict ) -> dict:
     temp_file_name = VideoReProcess.get_random_filename()
     temp_output_file = f"/tmp/meta_{temp_file_name}"
     try:
         input_path = Path(episode['path'])
-        metadata = {
-            "title": f"{episode['title']} - {episode['airdate']}",
-            "artist": episode["showName"],
-            "comment": "TV Party Tonight",
-            "year": str(episode['airdate'])
-        }
+        metadata = episode_metadata(episode)
 
-        if not input_path.exists():
+        # A missing source with a checkpoint is a reprocess that died mid-swap; let it finish
+        if not input_path.exists() and not ReprocessCheckpoint.load(episode['path']):
             logger.error(f"File not found - {episode['path']}")
             return { "success": False, "task": task_id, "error": f"File not found - {episode['path']}"}
 
         self.update_state(state="PROGRESS", meta={"step": "running ffmpeg", "file": episode['path']})
-        VideoReProcess.reprocess(episode['path'], metadata)
+        hooks = FFmpegTaskHooks(self, "running ffmpeg", episode['path'])
+
+        def transcode() -> dict:
+            processed = VideoReProcess.reprocess(episode['path'], metadata, on_progress=hooks.on_progress,
+                                                 should_stop=hooks.should_stop, chunk_workers=TRANSCODE_CHUNKS or cores_per_task(),
+                                                 keep_backup=KEEP_BACKUPS)
+            if hooks.reason:
+                return {"success": False, "error": f"reprocess aborted: {hooks.reason}"}
+            if not processed:
+                return {"success": False, "error": "reprocess failed"}
+            return {"success": True, "metadata": metadata}
+
+        # Rekeyed on the output too, so resubmitting a finished row doesn't transcode it again
+        result = TaskDedup.run_once(self, episode['path'], metadata, transcode, rekey=True)
 
     except subprocess.CalledProcessError as e:
         logger.error(f"FFmpeg error: {e.stderr.decode()}")
         return {"success": False, "task": task_id, "error": "ffmpeg failed"}
 
     else:
-        return {"success": True, "task": task_id, "metadata": metadata}
+        return {**result, "task": task_id}
 
     finally:
         if os.path.exists(temp_output_file):
@@ -0,0 +1,138 @@
+"""
+Module: db_pool
+---------------
+Per-process psycopg2 connection pools shared by task code, video_utils and the
+ingestion loop. Celery workers create theirs in `worker_process_init` (see
+celery_tasks); any other process gets one on first use.
+
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(query, params)
+
+The block commits on success and rolls back on error. A connection that has sat
+idle for PING_AFTER seconds is checked with SELECT 1 before it is handed out,
+and one that fails (check or query) is closed and replaced, so a dropped LAN
+connection or a restarted server costs a reconnect rather than a failed task.
+When every connection is checked out, callers wait up to POOL_TIMEOUT seconds
+for one to be returned instead of failing at once.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+MAX_CONNECTIONS = int(os.getenv("DB_POOL_MAX", 4))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 60))
+PING_AFTER = 30.0
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection that remembers when it was last returned to the pool (None until then)."""
+    last_used: Optional[float] = None
+
+
+class ConnectionPool(ThreadedConnectionPool):
+    """ThreadedConnectionPool whose `slots` semaphore makes callers wait for a free connection."""
+
+    def __init__(self, minconn: int, maxconn: int, **kwargs):
+        super().__init__(minconn, maxconn, connection_factory=PooledConnection, **kwargs)
+        self.slots = threading.BoundedSemaphore(maxconn)
+
+
+_pools: dict[tuple, ConnectionPool] = {}
+_pid: Optional[int] = None
+_lock = threading.Lock()
+
+
+def default_config() -> dict:
+    return {
+        'dbname': os.getenv("DB_NAME"),
+        'user': os.getenv("DB_USER"),
+        'password': os.getenv("DB_PASSWORD"),
+        'host': os.getenv("DB_HOST"),
+        'port': os.getenv("DB_PORT"),
+    }
+
+
+def init_pool(db_config: Optional[dict] = None, maxconn: int = MAX_CONNECTIONS) -> ConnectionPool:
+    """This process's pool for `db_config` (the DB_* environment by default), created on first call."""
+    global _pid
+    db_config = db_config or default_config()
+    key = tuple(sorted(db_config.items()))
+    with _lock:
+        if _pid != os.getpid():
+            # Pools copied from the parent by fork share its sockets: forget them, never close them
+            _pools.clear()
+            _pid = os.getpid()
+        if key not in _pools:
+            _pools[key] = ConnectionPool(0, maxconn, **db_config)
+        return _pools[key]
+
+
+def close_pools() -> None:
+    with _lock:
+        if _pid == os.getpid():
+            for pool in _pools.values():
+                pool.closeall()
+        _pools.clear()
+
+
+def _healthy(conn) -> bool:
+    if conn.closed:
+        return False
+    if conn.last_used is None or time.monotonic() - conn.last_used < PING_AFTER:
+        return True
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _checkout(pool: ConnectionPool) -> PooledConnection:
+    """A healthy connection from `pool`, replacing ones that fail the check; raises if none can be had."""
+    for _ in range(pool.maxconn + 1):
+        conn = pool.getconn()
+        if _healthy(conn):
+            return conn
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError("No healthy database connection after reconnecting")
+
+
+@contextmanager
+def db_connection(db_config: Optional[dict] = None):
+    """A healthy pooled connection; commits when the block exits cleanly, rolls back otherwise."""
+    pool = init_pool(db_config)
+    if not pool.slots.acquire(timeout=POOL_TIMEOUT):
+        raise PoolError(f"No database connection free after {POOL_TIMEOUT:.0f}s")
+    try:
+        conn = _checkout(pool)
+    except BaseException:
+        pool.slots.release()
+        raise
+
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        broken = broken or bool(conn.closed)
+        conn.last_used = time.monotonic()
+        pool.putconn(conn, close=broken)
+        pool.slots.release()
@@ -0,0 +1,318 @@
+"""
+Module: frame_analyzer
+----------------------
+Single-pass analysis of a video. ffmpeg decodes the file once into a downscaled
+rgb24 frame stream (stdout) and a mono PCM stream (second pipe), and every
+registered analyzer is fed from those two streams. This replaces separate
+blackdetect, cropdetect, OpenCV B&W and silencedetect passes over the same file.
+
+    pipeline = FrameAnalysisPipeline([
+        BlackFrameAnalyzer(), BlackWhiteAnalyzer(), CropAnalyzer(),
+        SceneChangeAnalyzer(), AudioLevelAnalyzer(),
+    ])
+    results = pipeline.run(video_path)
+    results["black"], results["bw"], results["crop"], results["scenes"], results["audio"]
+
+Analyzers receive frames in batches as (N, H, W, 3) uint8 arrays with their
+timestamps in seconds, and raw PCM chunks if they set `wants_audio`. A new
+analysis only needs a FrameAnalyzer subclass.
+"""
+
+import abc
+from typing import Optional
+
+import numpy as np
+
+from classes.video_utils import FFmpegRunner, PcmLevelMeter, VideoReProcess, IsBlackWhite
+
+
+def frame_luma(frames: np.ndarray) -> np.ndarray:
+    """BT.601 luma (0-255, float32) of (N, H, W, 3) rgb24 frames."""
+    rgb = frames.astype(np.float32)
+    return rgb[..., 0] * 0.299 + rgb[..., 1] * 0.587 + rgb[..., 2] * 0.114
+
+
+class FrameAnalyzer(abc.ABC):
+    """Base class for analyzers plugged into FrameAnalysisPipeline; subclasses must implement result()."""
+
+    name = "analyzer"
+    wants_frames = True
+    wants_audio = False
+
+    def start(self, info: dict) -> None:
+        """Called before decoding with the stream info (width, height, fps, source size, duration)."""
+        self.info = info
+
+    def on_frames(self, timestamps: np.ndarray, frames: np.ndarray) -> None:
+        pass
+
+    def on_audio(self, chunk: bytes) -> None:
+        pass
+
+    @abc.abstractmethod
+    def result(self):
+        """The analysis for the whole file, stored under `name` in the pipeline's results."""
+
+
+class BlackFrameAnalyzer(FrameAnalyzer):
+    """
+    Black segments with blackdetect semantics: a frame is black when at least
+    `pic_th` of its pixels have luma <= `pix_th` * 255, and runs of at least
+    `duration` seconds are reported as (start, end).
+    """
+
+    name = "black"
+
+    def __init__(self, duration: float = 0.8, pix_th: float = 0.1, pic_th: float = 0.98) -> None:
+        self.duration = duration
+        self.pix_th = pix_th
+        self.pic_th = pic_th
+        self.segments: list[tuple[float, float]] = []
+        self._run_start: Optional[float] = None
+        self._last_ts = 0.0
+
+    def on_frames(self, timestamps: np.ndarray, frames: np.ndarray) -> None:
+        black_ratio = (frame_luma(frames) <= self.pix_th * 255).mean(axis=(1, 2))
+        for ts, is_black in zip(timestamps.tolist(), (black_ratio >= self.pic_th).tolist()):
+            if is_black and self._run_start is None:
+                self._run_start = ts
+            elif not is_black and self._run_start is not None:
+                self._close_run(ts)
+            self._last_ts = ts
+
+    def _close_run(self, end: float) -> None:
+        if end - self._run_start >= self.duration:
+            self.segments.append((round(self._run_start, 3), round(end, 3)))
+        self._run_start = None
+
+    def result(self) -> list[tuple[float, float]]:
+        if self._run_start is not None:
+            self._close_run(self._last_ts + 1 / self.info["fps"])
+        return self.segments
+
+
+class BlackWhiteAnalyzer(FrameAnalyzer):
+    """
+    Black-and-white classification with IsBlackWhite's chroma score: the video is
+    B&W when at least `min_share` of the non-dark frames stay under `tolerance`.
+    """
+
+    name = "bw"
+
+    def __init__(self, tolerance: int = 12, min_share: float = 0.95) -> None:
+        self.tolerance = tolerance
+        self.min_share = min_share
+        self._scores: list[np.ndarray] = []
+
+    def on_frames(self, timestamps: np.ndarray, frames: np.ndarray) -> None:
+        self._scores.append(IsBlackWhite.bw_frame_scores(frames))
+
+    def result(self) -> dict:
+        scores = np.concatenate(self._scores) if self._scores else np.zeros(0)
+        is_bw, confidence = IsBlackWhite.classify_bw_scores(scores, self.tolerance, self.min_share)
+        return {"is_bw": is_bw, "confidence": confidence, "frames": int(scores.size)}
+
+
+class CropAnalyzer(FrameAnalyzer):
+    """
+    Letterbox/pillarbox detection like cropdetect: the content box is where any
+    pixel's luma exceeds `limit`. Per-frame boxes are combined with a percentile
+    so a few dark frames don't widen the crop, then scaled back to source pixels
+    and rounded to multiples of `round_to` (cropdetect's default rounding).
+    """
+
+    name = "crop"
+
+    def __init__(self, limit: int = 24, round_to: int = 16) -> None:
+        self.limit = limit
+        self.round_to = round_to
+        self._boxes: list[np.ndarray] = []
+
+    def on_frames(self, timestamps: np.ndarray, frames: np.ndarray) -> None:
+        bright = frame_luma(frames) > self.limit
+        rows = bright.any(axis=2)
+        cols = bright.any(axis=1)
+        has_content = rows.any(axis=1)
+        if not has_content.any():
+            return
+        rows, cols = rows[has_content], cols[has_content]
+        height, width = rows.shape[1], cols.shape[1]
+        top = rows.argmax(axis=1)
+        bottom = height - 1 - rows[:, ::-1].argmax(axis=1)
+        left = cols.argmax(axis=1)
+        right = width - 1 - cols[:, ::-1].argmax(axis=1)
+        self._boxes.append(np.stack([left, top, right, bottom], axis=1))
+
+    def result(self) -> Optional[str]:
+        if not self._boxes:
+            return None
+        boxes = np.concatenate(self._boxes)
+        x1, y1 = np.percentile(boxes[:, 0], 5), np.percentile(boxes[:, 1], 5)
+        x2, y2 = np.percentile(boxes[:, 2], 95), np.percentile(boxes[:, 3], 95)
+
+        scale_x = self.info["source_width"] / self.info["width"]
+        scale_y = self.info["source_height"] / self.info["height"]
+        x, y = int(x1 * scale_x), int(y1 * scale_y)
+        w = min(int((x2 + 1) * scale_x), self.info["source_width"]) - x
+        h = min(int((y2 + 1) * scale_y), self.info["source_height"]) - y
+
+        # Same rounding as cropdetect: shrink to a multiple and keep the box centred
+        w_round, h_round = w - w % self.round_to, h - h % self.round_to
+        x += (w - w_round) // 2
+        y += (h - h_round) // 2
+        return f"{w_round}:{h_round}:{x}:{y}"
+
+
+class SceneChangeAnalyzer(FrameAnalyzer):
+    """Scene cuts scored by mean absolute luma difference between consecutive frames (0-1)."""
+
+    name = "scenes"
+
+    def __init__(self, threshold: float = 0.3) -> None:
+        self.threshold = threshold
+        self.cuts: list[tuple[float, float]] = []
+        self._previous: Optional[np.ndarray] = None
+
+    def on_frames(self, timestamps: np.ndarray, frames: np.ndarray) -> None:
+        luma = frame_luma(frames)
+        if self._previous is not None:
+            luma_seq = np.concatenate([self._previous[None], luma])
+        else:
+            luma_seq = luma
+            timestamps = timestamps[1:]
+        scores = np.abs(np.diff(luma_seq, axis=0)).mean(axis=(1, 2)) / 255
+        for ts, score in zip(timestamps.tolist(), scores.tolist()):
+            if score >= self.threshold:
+                self.cuts.append((round(ts, 3), round(score, 3)))
+        self._previous = luma[-1]
+
+    def result(self) -> list[tuple[float, float]]:
+        return self.cuts
+
+
+class AudioLevelAnalyzer(FrameAnalyzer):
+    """Windowed RMS/peak levels; the result works with CommercialBreaks.silence_from_levels."""
+
+    name = "audio"
+    wants_frames = False
+    wants_audio = True
+
+    def __init__(self, window: float = 0.05) -> None:
+        self.window = window
+        self.meter: Optional[PcmLevelMeter] = None
+
+    def start(self, info: dict) -> None:
+        super().start(info)
+        self.meter = PcmLevelMeter(sample_rate=info["sample_rate"], window=self.window)
+
+    def on_audio(self, chunk: bytes) -> None:
+        self.meter.feed(chunk)
+
+    def result(self) -> dict:
+        return self.meter.levels()
+
+
+class FrameAnalysisPipeline:
+    """
+    Decode a video once and feed every registered analyzer.
+
+    Attributes:
+        analyzers (list[FrameAnalyzer]): Registered analyzers, keyed by `name` in results.
+        width (int): Width of the analysis frames; height keeps the source aspect.
+        fps (float): Analysis frame rate.
+        sample_rate (int): PCM sample rate for audio analyzers.
+        batch_size (int): Frames handed to analyzers per call.
+    """
+
+    def __init__(self, analyzers: Optional[list] = None, width: int = 320, fps: float = 10,
+                 sample_rate: int = 8000, batch_size: int = 32) -> None:
+        self.analyzers: list[FrameAnalyzer] = []
+        self.width = width
+        self.fps = fps
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        for analyzer in analyzers or []:
+            self.register(analyzer)
+
+    def register(self, analyzer: FrameAnalyzer) -> None:
+        if any(existing.name == analyzer.name for existing in self.analyzers):
+            raise ValueError(f"Analyzer '{analyzer.name}' is already registered.")
+        self.analyzers.append(analyzer)
+
+    def run(self, video_path: str, on_progress=None, should_stop=None) -> Optional[dict]:
+        """
+        Returns:
+            {analyzer.name: analyzer.result()} or None if the decode failed or was aborted.
+        """
+        metadata = VideoReProcess.get_metadata(str(video_path))
+        video = next((st for st in metadata.get("streams", []) if st.get("codec_type") == "video"), None)
+        has_audio = any(st.get("codec_type") == "audio" for st in metadata.get("streams", []))
+        if video is None:
+            print(f"[ERROR] No video stream in {video_path}")
+            return None
+
+        height = int(round(self.width * int(video["height"]) / int(video["width"]) / 2)) * 2
+        info = {
+            "width": self.width,
+            "height": height,
+            "fps": self.fps,
+            "sample_rate": self.sample_rate,
+            "source_width": int(video["width"]),
+            "source_height": int(video["height"]),
+            "duration": float(metadata.get("format", {}).get("duration", 0) or 0),
+        }
+        frame_analyzers = [a for a in self.analyzers if a.wants_frames]
+        audio_analyzers = [a for a in self.analyzers if a.wants_audio] if has_audio else []
+        for analyzer in self.analyzers:
+            analyzer.start(info)
+
+        frame_bytes = self.width * height * 3
+        batch_bytes = frame_bytes * self.batch_size
+        pending = bytearray()
+        frame_count = 0
+
+        def feed_frames(data: bytes) -> None:
+            nonlocal frame_count
+            frames = np.frombuffer(data, dtype=np.uint8).reshape(-1, height, self.width, 3)
+            timestamps = (np.arange(len(frames)) + frame_count) / self.fps
+            frame_count += len(frames)
+            for analyzer in frame_analyzers:
+                analyzer.on_frames(timestamps, frames)
+
+        def on_video(chunk: bytes) -> None:
+            pending.extend(chunk)
+            if len(pending) >= batch_bytes:
+                usable = len(pending) // frame_bytes * frame_bytes
+                feed_frames(bytes(pending[:usable]))
+                del pending[:usable]
+
+        def on_audio(chunk: bytes) -> None:
+            for analyzer in audio_analyzers:
+                analyzer.on_audio(chunk)
+
+        cmd = [
+            "ffmpeg", "-hide_banner", "-i", str(video_path),
+            "-map", "0:v:0", "-vf", f"fps={self.fps},scale={self.width}:{height}",
+            "-pix_fmt", "rgb24", "-f", "rawvideo", "pipe:1",
+        ]
+        pipes = {}
+        if audio_analyzers:
+            cmd += ["-map", "0:a:0", "-ac", "1", "-ar", str(self.sample_rate), "-c:a", "pcm_s16le", "-f", "s16le",
+                    "pipe:audio"]
+            pipes["audio"] = on_audio
+
+        runner = FFmpegRunner(cmd, duration=info["duration"] or None, on_progress=on_progress,
+                              should_stop=should_stop, on_data=on_video, pipes=pipes)
+        stderr = runner.run()
+        if runner.aborted or runner.returncode != 0:
+            print(f"[ERROR] Frame analysis failed for {video_path}: {stderr[-5:]}")
+            return None
+
+        usable = len(pending) // frame_bytes * frame_bytes
+        if usable:
+            feed_frames(bytes(pending[:usable]))
+
+        return {
+            analyzer.name: analyzer.result() if analyzer.wants_frames or analyzer in audio_analyzers else None
+            for analyzer in self.analyzers
+        }
@@ -0,0 +1,244 @@
+"""
+Module: mp4_metadata
+--------------------
+In-place MP4 tag editing. Mp4MetadataEditor.write_tags replaces the iTunes-style
+tags in moov/udta/meta/ilst (and drops the per-track udta tags) without touching
+the media data, so retagging a file rewrites a few kilobytes instead of remuxing it.
+
+Media samples are addressed by absolute offsets into mdat (stco/co64), and mdat
+never moves here, so no offsets need patching. The new moov either:
+  * overwrites the old one, when it fits in the old moov plus any free/skip
+    boxes right after it (the remainder becomes a free box), or when the moov is
+    the last box in the file (the file is truncated or extended), or
+  * is appended at the end of the file, and the old moov is retyped to free.
+
+    undo = Mp4MetadataEditor.write_tags(path, {"title": "...", "artist": "..."},
+                                        save_undo=lambda undo: Mp4MetadataEditor.save_undo(sidecar, undo))
+    if undo is None:
+        ...  # layout not supported, nothing was written; remux instead
+    elif not verified:
+        Mp4MetadataEditor.restore(path, undo)  # byte-identical to before
+
+With `save_undo` the undo record is made durable before the first byte changes,
+so a write interrupted by a crash can still be rolled back (load_undo, restore).
+"""
+
+import base64
+import json
+import os
+import struct
+from typing import Callable, Optional
+
+
+class Mp4MetadataEditor:
+
+    # ffmpeg metadata keys -> ilst item types
+    ILST_TAGS = {
+        "title": b"\xa9nam",
+        "artist": b"\xa9ART",
+        "album": b"\xa9alb",
+        "comment": b"\xa9cmt",
+        "year": b"\xa9day",
+        "date": b"\xa9day",
+        "genre": b"\xa9gen",
+        "description": b"desc",
+    }
+    FREE_TYPES = (b"free", b"skip")
+    # Track-level udta entries that are tags too (ffmpeg writes the track name as "name")
+    TRACK_TAG_TYPES = (b"meta", b"name")
+
+    @staticmethod
+    def _box(box_type: bytes, payload: bytes) -> bytes:
+        return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+    @staticmethod
+    def _parse(data: bytes, start: int, end: int) -> list[tuple[bytes, int, int]]:
+        """(type, offset, size) of the boxes in data[start:end]."""
+        boxes = []
+        pos = start
+        while pos + 8 <= end:
+            size, box_type = struct.unpack(">I4s", data[pos:pos + 8])
+            if size == 1:
+                size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+            elif size == 0:
+                size = end - pos
+            if size < 8 or pos + size > end:
+                raise ValueError(f"Bad {box_type!r} box at {pos}")
+            boxes.append((box_type, pos, size))
+            pos += size
+        return boxes
+
+    @staticmethod
+    def _top_level(f, file_size: int) -> Optional[list[tuple[bytes, int, int]]]:
+        """(type, offset, size) of the top-level boxes, reading only their headers.
+        None if a box runs to end of file (size 0), since nothing can follow it."""
+        boxes = []
+        pos = 0
+        while pos + 8 <= file_size:
+            f.seek(pos)
+            size, box_type = struct.unpack(">I4s", f.read(8))
+            if size == 1:
+                size = struct.unpack(">Q", f.read(8))[0]
+            elif size == 0:
+                return None
+            if size < 8 or pos + size > file_size:
+                raise ValueError(f"Bad {box_type!r} box at {pos}")
+            boxes.append((box_type, pos, size))
+            pos += size
+        return boxes
+
+    @staticmethod
+    def build_ilst(metadata: dict[str, str]) -> bytes:
+        items = b""
+        for key, value in metadata.items():
+            data = Mp4MetadataEditor._box(b"data", struct.pack(">II", 1, 0) + str(value).encode("utf-8"))
+            items += Mp4MetadataEditor._box(Mp4MetadataEditor.ILST_TAGS[key], data)
+        return Mp4MetadataEditor._box(b"ilst", items)
+
+    @staticmethod
+    def build_moov(moov: bytes, metadata: dict[str, str]) -> Optional[bytes]:
+        """The moov with its udta tags replaced by `metadata` and the track tags dropped; None for fragmented files."""
+        header = 16 if struct.unpack(">I", moov[:4])[0] == 1 else 8
+        children = Mp4MetadataEditor._parse(moov, header, len(moov))
+        if any(box_type == b"mvex" for box_type, _, _ in children):
+            return None
+
+        body = b""
+        kept_udta = b""
+        for box_type, offset, size in children:
+            if box_type == b"udta":
+                kept_udta += Mp4MetadataEditor._untagged(moov, offset, size, (b"meta",))
+            elif box_type == b"trak":
+                body += Mp4MetadataEditor._build_trak(moov, offset, size)
+            else:
+                body += moov[offset:offset + size]
+
+        hdlr = Mp4MetadataEditor._box(b"hdlr", struct.pack(">II4s", 0, 0, b"mdir") + b"appl" + bytes(9))
+        meta = Mp4MetadataEditor._box(b"meta", struct.pack(">I", 0) + hdlr + Mp4MetadataEditor.build_ilst(metadata))
+        return Mp4MetadataEditor._box(b"moov", body + Mp4MetadataEditor._box(b"udta", kept_udta + meta))
+
+    @staticmethod
+    def _untagged(data: bytes, offset: int, size: int, tag_types: tuple) -> bytes:
+        """The entries of the udta at `offset` that aren't tags (e.g. chapters): drops
+        `tag_types` and QuickTime (c)xxx strings."""
+        return b"".join(
+            data[child_offset:child_offset + child_size]
+            for child_type, child_offset, child_size in Mp4MetadataEditor._parse(data, offset + 8, offset + size)
+            if child_type not in tag_types and not child_type.startswith(b"\xa9")
+        )
+
+    @staticmethod
+    def _build_trak(moov: bytes, offset: int, size: int) -> bytes:
+        """The trak at `offset` with the tags dropped from its udta, like -map_metadata -1."""
+        header = 16 if struct.unpack(">I", moov[offset:offset + 4])[0] == 1 else 8
+        children = Mp4MetadataEditor._parse(moov, offset + header, offset + size)
+        if not any(box_type == b"udta" for box_type, _, _ in children):
+            return moov[offset:offset + size]
+
+        body = b""
+        for box_type, child_offset, child_size in children:
+            if box_type != b"udta":
+                body += moov[child_offset:child_offset + child_size]
+                continue
+            kept = Mp4MetadataEditor._untagged(moov, child_offset, child_size, Mp4MetadataEditor.TRACK_TAG_TYPES)
+            if kept:
+                body += Mp4MetadataEditor._box(b"udta", kept)
+        return Mp4MetadataEditor._box(b"trak", body)
+
+    @staticmethod
+    def write_tags(file_path: str, metadata: dict[str, str],
+                   save_undo: Optional[Callable[[dict], None]] = None) -> Optional[dict]:
+        """
+        Replace the file's tags with `metadata` in place. `save_undo` is called
+        with the undo record before the file is modified.
+
+        Returns:
+            An undo record for restore(), or None if the layout or keys aren't
+            supported (QuickTime brand, fragmented or unsized boxes, unknown
+            tag names), in which case the file was not touched.
+        """
+        if any(key not in Mp4MetadataEditor.ILST_TAGS for key in metadata):
+            return None
+
+        with open(file_path, "r+b") as f:
+            file_size = os.fstat(f.fileno()).st_size
+            boxes = Mp4MetadataEditor._top_level(f, file_size)
+            if not boxes or boxes[0][0] != b"ftyp":
+                return None
+            f.seek(boxes[0][1] + 8)
+            if f.read(4) == b"qt  ":
+                return None
+
+            types = [box_type for box_type, _, _ in boxes]
+            if types.count(b"moov") != 1 or b"moof" in types:
+                return None
+            index = types.index(b"moov")
+            _, moov_offset, moov_size = boxes[index]
+
+            f.seek(moov_offset)
+            new_moov = Mp4MetadataEditor.build_moov(f.read(moov_size), metadata)
+            if new_moov is None:
+                return None
+
+            # Room for the new moov: the old one plus any free space right after it
+            slot_end = moov_offset + moov_size
+            for box_type, offset, size in boxes[index + 1:]:
+                if box_type not in Mp4MetadataEditor.FREE_TYPES:
+                    break
+                slot_end = offset + size
+            spare = slot_end - moov_offset - len(new_moov)
+
+            if spare == 0 or spare >= 8 or slot_end == file_size:
+                f.seek(moov_offset)
+                undo = {"size": file_size, "writes": [(moov_offset, f.read(slot_end - moov_offset))]}
+                if save_undo is not None:
+                    save_undo(undo)
+                f.seek(moov_offset)
+                f.write(new_moov)
+                if slot_end == file_size:
+                    f.truncate(moov_offset + len(new_moov))
+                elif spare:
+                    f.write(Mp4MetadataEditor._box(b"free", bytes(spare - 8)))
+            else:
+                # Append, make it durable, and only then retire the old moov
+                undo = {"size": file_size, "writes": [(moov_offset + 4, b"moov")]}
+                if save_undo is not None:
+                    save_undo(undo)
+                f.seek(file_size)
+                f.write(new_moov)
+                f.flush()
+                os.fsync(f.fileno())
+                f.seek(moov_offset + 4)
+                f.write(b"free")
+            f.flush()
+            os.fsync(f.fileno())
+        return undo
+
+    @staticmethod
+    def restore(file_path: str, undo: dict) -> None:
+        """Put back the bytes write_tags replaced."""
+        with open(file_path, "r+b") as f:
+            for offset, data in undo["writes"]:
+                f.seek(offset)
+                f.write(data)
+            f.truncate(undo["size"])
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def save_undo(path: str, undo: dict) -> None:
+        """Write an undo record to `path` durably (atomic replace after fsync)."""
+        record = {"size": undo["size"],
+                  "writes": [(offset, base64.b64encode(data).decode()) for offset, data in undo["writes"]]}
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(record, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def load_undo(path: str) -> dict:
+        with open(path, "r") as f:
+            record = json.load(f)
+        return {"size": record["size"],
+                "writes": [(offset, base64.b64decode(data)) for offset, data in record["writes"]]}
@@ -1,4 +1,5 @@
 import contextlib
+import fcntl
 import io
 import json
 import random
@@ -8,9 +9,8 @@ from time import sleep
 import numpy as np
 import matplotlib
 import pandas as pd
-import psycopg2
 from dotenv import load_dotenv
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 
 matplotlib.use("TkAgg")
 import matplotlib.pyplot as plt
@@ -19,90 +19,453 @@ import cv2
 import math
 import os
 import re
+import selectors
 import hashlib
+import itertools
 import subprocess
+import tempfile
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
 from pathlib import Path
-from urllib.parse import urlparse
 
 from matplotlib.widgets import Button
 from sklearn.metrics import confusion_matrix
 from typing import Union, List, Optional
 from PIL import Image
 
+# Relative, so the root scripts can import this module as my_celery.classes.video_utils
+from .db_pool import db_connection
+from .mp4_metadata import Mp4MetadataEditor
+
 load_dotenv()
 
+
+class FFmpegRunner:
+    """
+    Run ffmpeg with stderr streamed line by line and `-progress` reporting.
+
+    Nothing is buffered beyond the current line, so long jobs don't hold their
+    whole log in memory. Progress is reported through `on_progress` as a dict
+    (percent, eta, fps, speed, out_time), and `should_stop` is polled so the
+    caller can abort ffmpeg early, e.g. when a Celery task is revoked.
+
+        runner = FFmpegRunner(cmd, on_progress=report, should_stop=check)
+        for line in runner.lines():
+            ...
+        runner.returncode, runner.aborted
+
+    When `on_data` is given, ffmpeg's stdout is treated as a data stream (e.g.
+    raw PCM written to pipe:1) and each chunk is passed to `on_data`; progress is
+    then read from a separate pipe instead. Further outputs can be named in
+    `pipes`: an output written to "pipe:<name>" in `cmd` is delivered to
+    `pipes[name]`.
+    """
+
+    def __init__(self, cmd: list, duration: Optional[float] = None, on_progress=None, should_stop=None,
+                 on_data=None, pipes: Optional[dict] = None) -> None:
+        """
+        Args:
+            cmd: ffmpeg command line, starting with the ffmpeg binary.
+            duration: Input duration in seconds. If omitted it is read from
+                      the "Duration:" line ffmpeg prints at info log level.
+            on_progress: Callable receiving a progress dict.
+            should_stop: Callable returning True to terminate ffmpeg.
+            on_data: Callable receiving raw stdout chunks (bytes).
+            pipes: {name: callable} for extra outputs written to "pipe:<name>".
+        """
+        self.cmd = cmd
+        self.duration = duration
+        self.on_progress = on_progress
+        self.should_stop = should_stop
+        self.on_data = on_data
+        self.pipes = pipes or {}
+        self.returncode: Optional[int] = None
+        self.aborted = False
+        self._progress: dict[str, str] = {}
+
+    def lines(self):
+        """Start ffmpeg and yield its stderr lines as they arrive."""
+        # Extra outputs get their own pipe; the child sees the same fd numbers
+        read_fds, write_fds = {}, {}
+        for name in self.pipes:
+            read_fds[name], write_fds[name] = os.pipe()
+
+        if self.on_data is None:
+            progress_fd = None
+            progress_target = "pipe:1"
+        else:
+            # stdout carries data, so progress goes to its own pipe
+            progress_fd, write_fds[None] = os.pipe()
+            progress_target = f"pipe:{write_fds[None]}"
+
+        cmd = [self.cmd[0], "-nostats", "-progress", progress_target]
+        for arg in self.cmd[1:]:
+            name = arg[len("pipe:"):] if isinstance(arg, str) and arg.startswith("pipe:") else None
+            cmd.append(f"pipe:{write_fds[name]}" if name in self.pipes else arg)
+
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                pass_fds=tuple(write_fds.values()))
+        for fd in write_fds.values():
+            os.close(fd)
+
+        sel = selectors.DefaultSelector()
+        if progress_fd is None:
+            sel.register(proc.stdout, selectors.EVENT_READ, "progress")
+        else:
+            sel.register(proc.stdout, selectors.EVENT_READ, self.on_data)
+            sel.register(progress_fd, selectors.EVENT_READ, "progress")
+        for name, fd in read_fds.items():
+            sel.register(fd, selectors.EVENT_READ, self.pipes[name])
+        sel.register(proc.stderr, selectors.EVENT_READ, "stderr")
+        pending = {"progress": b"", "stderr": b""}
+
+        try:
+            while sel.get_map():
+                for key, _ in sel.select(timeout=1.0):
+                    chunk = os.read(key.fd, 65536)
+                    if callable(key.data):
+                        if chunk:
+                            key.data(chunk)
+                        else:
+                            sel.unregister(key.fileobj)
+                        continue
+
+                    if chunk:
+                        *complete, pending[key.data] = (pending[key.data] + chunk).split(b"\n")
+                    else:
+                        sel.unregister(key.fileobj)
+                        complete, pending[key.data] = [pending[key.data]], b""
+
+                    for raw in complete:
+                        line = raw.decode(errors="replace").rstrip("\r")
+                        if key.data == "progress":
+                            self._handle_progress(line)
+                        elif line:
+                            self._handle_duration(line)
+                            yield line
+
+                if self.should_stop is not None and self.should_stop():
+                    self.aborted = True
+                    proc.terminate()
+                    break
+
+            self.returncode = proc.wait()
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            sel.close()
+            proc.stdout.close()
+            proc.stderr.close()
+            for fd in [progress_fd, *read_fds.values()]:
+                if fd is not None:
+                    os.close(fd)
+
+    def run(self) -> list[str]:
+        """Run ffmpeg to completion and return its stderr lines."""
+        return list(self.lines())
+
+    def _handle_duration(self, line: str) -> None:
+        if self.duration is not None:
+            return
+        match = re.search(r"Duration: (\d+):(\d+):(\d+\.?\d*)", line)
+        if match:
+            h, m, s = match.groups()
+            self.duration = int(h) * 3600 + int(m) * 60 + float(s)
+
+    def _handle_progress(self, line: str) -> None:
+        if "=" not in line:
+            return
+        key, value = (part.strip() for part in line.split("=", 1))
+        self._progress[key] = value
+        if key != "progress":
+            return
+
+        try:
+            out_time = int(self._progress.get("out_time_us", 0)) / 1_000_000
+        except ValueError:
+            out_time = 0.0
+        try:
+            speed = float(self._progress.get("speed", "").rstrip("x"))
+        except ValueError:
+            speed = None
+        try:
+            fps = float(self._progress.get("fps", 0))
+        except ValueError:
+            fps = 0.0
+
+        percent = eta = None
+        if self.duration:
+            percent = round(min(100.0, out_time / self.duration * 100), 1)
+            if speed:
+                eta = round(max(0.0, self.duration - out_time) / speed)
+
+        if self.on_progress is not None:
+            self.on_progress({
+                "percent": 100.0 if value == "end" else percent,
+                "eta": 0 if value == "end" else eta,
+                "fps": fps,
+                "speed": speed,
+                "out_time": round(out_time, 2),
+            })
+
+
+class PcmLevelMeter:
+    """
+    Fold a stream of mono s16le PCM into per-window RMS and peak levels.
+
+        meter = PcmLevelMeter(sample_rate=8000, window=0.05)
+        meter.feed(chunk)  # any chunk size
+        levels = meter.levels()
+    """
+
+    def __init__(self, sample_rate: int = 8000, window: float = 0.05) -> None:
+        self.window = window
+        self.samples_per_window = max(1, int(sample_rate * window))
+        self._pending = bytearray()
+        self._rms: list[np.ndarray] = []
+        self._peak: list[np.ndarray] = []
+
+    def feed(self, chunk: bytes) -> None:
+        """Add PCM bytes; complete windows are measured immediately."""
+        self._pending.extend(chunk)
+        window_bytes = self.samples_per_window * 2
+        usable = len(self._pending) // window_bytes * window_bytes
+        if usable:
+            self._add_windows(bytes(self._pending[:usable]), self.samples_per_window)
+            del self._pending[:usable]
+
+    def levels(self) -> dict:
+        """
+        Returns:
+            {"window": seconds, "rms_db": ndarray, "peak_db": ndarray, "integrated_db": float}
+            with levels in dBFS. integrated_db is the mean energy of windows above -70 dBFS.
+            A trailing partial window is measured as well.
+        """
+        tail = len(self._pending) // 2
+        if tail:
+            self._add_windows(bytes(self._pending[:tail * 2]), tail)
+            self._pending.clear()
+
+        rms = np.concatenate(self._rms) if self._rms else np.zeros(0, dtype=np.float32)
+        peak = np.concatenate(self._peak) if self._peak else np.zeros(0, dtype=np.float32)
+        rms_db = 20 * np.log10(np.maximum(rms, 1e-10))
+        peak_db = 20 * np.log10(np.maximum(peak, 1e-10))
+
+        gated = rms[rms_db > -70]
+        integrated_db = float(10 * np.log10(np.mean(gated * gated))) if gated.size else -200.0
+        return {"window": self.window, "rms_db": rms_db, "peak_db": peak_db, "integrated_db": integrated_db}
+
+    def _add_windows(self, data: bytes, samples: int) -> None:
+        block = np.frombuffer(data, dtype="<i2").astype(np.float32).reshape(-1, samples) / 32768.0
+        self._rms.append(np.sqrt(np.mean(block * block, axis=1)))
+        self._peak.append(np.max(np.abs(block), axis=1))
+
+
+class AnalysisCache:
+    """
+    JSON cache of per-file analysis results (crop values, loudness stats), so a
+    retried or re-profiled transcode can skip its analysis decode.
+
+    Entries are keyed by file identity (size, mtime and a hash of the first and
+    last HASH_BYTES) plus the analysis name and its parameters, and live in
+    ANALYSIS_CACHE_DIR, by default on the library volume (DIR_ROOT_PI) so every
+    worker sees them. The /tmp fallback without DIR_ROOT_PI is per host.
+    """
+
+    CACHE_DIR = os.getenv("ANALYSIS_CACHE_DIR") or (
+        f"{os.getenv('DIR_ROOT_PI')}/.analysis_cache" if os.getenv("DIR_ROOT_PI") else "/tmp/analysis_cache")
+    HASH_BYTES = 1 << 20
+
+    @staticmethod
+    def file_identity(file_path: str) -> str:
+        stat = os.stat(file_path)
+        digest = hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+        with open(file_path, "rb") as f:
+            digest.update(f.read(AnalysisCache.HASH_BYTES))
+            if stat.st_size > 2 * AnalysisCache.HASH_BYTES:
+                f.seek(-AnalysisCache.HASH_BYTES, os.SEEK_END)
+                digest.update(f.read(AnalysisCache.HASH_BYTES))
+        return digest.hexdigest()
+
+    @staticmethod
+    def _entry_path(file_path: str, analysis: str, params: dict) -> str:
+        params_hash = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+        return f"{AnalysisCache.CACHE_DIR}/{AnalysisCache.file_identity(file_path)}_{analysis}_{params_hash}.json"
+
+    @staticmethod
+    def get(file_path: str, analysis: str, params: dict) -> Optional[dict]:
+        """Cached result for this file/analysis/params, or None."""
+        try:
+            with open(AnalysisCache._entry_path(file_path, analysis, params), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def put(file_path: str, analysis: str, params: dict, result: dict) -> None:
+        try:
+            os.makedirs(AnalysisCache.CACHE_DIR, exist_ok=True)
+            entry_path = AnalysisCache._entry_path(file_path, analysis, params)
+            fd, temp_path = tempfile.mkstemp(dir=AnalysisCache.CACHE_DIR, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(result, f)
+            os.replace(temp_path, entry_path)
+        except OSError as e:
+            print(f"[WARN] Could not cache {analysis} for {file_path}: {e}")
+
+
 class IsBlackWhite:
 
     @staticmethod
     def insert_bw(episode_id: int, is_bw: bool):
 
-        db_config = {
-            'dbname': os.getenv("DB_NAME"),
-            'user': os.getenv("DB_USER"),
-            'password': os.getenv("DB_PASSWORD"),
-            'host': os.getenv("DB_HOST"),
-            'port': os.getenv("DB_PORT"),
-        }
-
         update_query = f"""UPDATE episodes SET is_bw = %s WHERE episode_id = %s;"""
 
 
         try:
-            conn = psycopg2.connect(**db_config)
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            cur.execute(update_query, (episode_id, is_bw))
-            conn.commit()
-            cur.close()
-            conn.close()
+            with db_connection() as conn:
+                cur = conn.cursor(cursor_factory=RealDictCursor)
+                cur.execute(update_query, (is_bw, episode_id))
+                cur.close()
 
         except Exception as e:
             print(f"Database query failed: {e}")
             return None
 
     @staticmethod
-    def is_bw_frame(frame, tolerance=5):
-        return np.all(np.abs(frame[:, :, 0] - frame[:, :, 1]) < tolerance) and \
-            np.all(np.abs(frame[:, :, 1] - frame[:, :, 2]) < tolerance)
+    def insert_bw_bulk(results: list[tuple[int, bool]], table: str = "episodes", id_column: str = "episode_id",
+                       db_config: Optional[dict] = None) -> int:
+        """
+        Write many (media_id, is_bw) results with one multi-row UPDATE.
+        `table`/`id_column` select episodes, movies or specials.
+
+        Returns:
+            Number of rows updated (0 on failure).
+        """
+        if not results:
+            return 0
+
+        update_query = f"""UPDATE {table} AS t SET is_bw = v.is_bw
+                           FROM (VALUES %s) AS v(media_id, is_bw)
+                           WHERE t.{id_column} = v.media_id;"""
+
+        try:
+            with db_connection(db_config) as conn:
+                cur = conn.cursor()
+                execute_values(cur, update_query, results, page_size=len(results))
+                updated = cur.rowcount
+                cur.close()
+            return updated
+
+        except Exception as e:
+            print(f"Database query failed: {e}")
+            return 0
+
+    @staticmethod
+    def bw_frame_scores(frames: np.ndarray, min_level: float = 16) -> np.ndarray:
+        """
+        Colourfulness score per frame of an (N, H, W, 3) uint8 stack: the 95th percentile
+        of max-minus-min channel per pixel. Frames darker than `min_level` on average
+        carry no colour information and are skipped.
+        """
+        frames = np.asarray(frames)
+        lit = frames.reshape(len(frames), -1).mean(axis=1) > min_level
+        if not lit.any():
+            return np.zeros(0)
+        frames = frames[lit]
+        chroma = frames.max(axis=-1).astype(np.int16) - frames.min(axis=-1).astype(np.int16)
+        return np.percentile(chroma.reshape(len(frames), -1), 95, axis=1)
 
     @staticmethod
-    def is_video_black_and_white_opencv(video_path, max_samples=20):
-        cap = cv2.VideoCapture(video_path)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        step = max(total_frames // max_samples, 1)
-        count_bw = 0
-        for i in range(0, total_frames, step):
-            cap.set(cv2.CAP_PROP_POS_FRAMES, i)
-            ret, frame = cap.read()
-            if not ret:
-                continue
-            if IsBlackWhite.is_bw_frame(frame):
-                count_bw += 1
-        cap.release()
-        return count_bw >= max_samples * 0.95  # 95% of sampled frames are grayscale
+    def classify_bw_scores(scores: np.ndarray, tolerance: float = 12,
+                           min_share: float = 0.95) -> tuple[Optional[bool], float]:
+        """
+        Returns (is_bw, confidence). The video is B&W when at least `min_share` of the
+        scored frames stay under `tolerance`; confidence is the share of frames that
+        agree with the verdict. (None, 0.0) when there was nothing to score.
+        """
+        scores = np.asarray(scores)
+        if not scores.size:
+            return None, 0.0
+        share = float(np.mean(scores < tolerance))
+        is_bw = share >= min_share
+        return is_bw, round(share if is_bw else 1 - share, 3)
+
+    @staticmethod
+    def is_video_black_and_white(video_path, samples: int = 20, width: int = 160, tolerance: float = 12,
+                                 min_share: float = 0.95) -> tuple[Optional[bool], float]:
+        """
+        Seek-free B&W check: decode keyframes only, keep `samples` evenly spaced ones
+        scaled to `width` px, and score them as one array with bw_frame_scores.
+
+        Returns:
+            (is_bw, confidence) as classify_bw_scores, or (None, 0.0) if no frames were read.
+        """
+        metadata = VideoReProcess.get_metadata(str(video_path))
+        video = next((st for st in metadata.get("streams", []) if st.get("codec_type") == "video"), None)
+        duration = float(metadata.get("format", {}).get("duration", 0) or 0)
+        if video is None or duration <= 0:
+            print(f"[ERROR] Cannot probe video stream of {video_path}")
+            return None, 0.0
+
+        height = int(round(width * int(video["height"]) / int(video["width"]) / 2)) * 2
+        cmd = [
+            "ffmpeg", "-v", "error", "-skip_frame", "nokey", "-i", str(video_path),
+            "-map", "0:v:0", "-vf", f"fps={samples}/{duration:.3f},scale={width}:{height}",
+            "-frames:v", str(samples), "-pix_fmt", "rgb24", "-f", "rawvideo", "pipe:1"
+        ]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        frame_bytes = width * height * 3
+        count = len(result.stdout) // frame_bytes
+        if not count:
+            print(f"[ERROR] No frames read from {video_path}: {result.stderr.decode(errors='replace').strip()}")
+            return None, 0.0
+
+        frames = np.frombuffer(result.stdout[:count * frame_bytes], dtype=np.uint8).reshape(count, height, width, 3)
+        return IsBlackWhite.classify_bw_scores(IsBlackWhite.bw_frame_scores(frames), tolerance, min_share)
 
 
 class CommercialBreaks:
+    # Combined black+silence count above which merge_segments uses the NumPy join
+    NUMPY_JOIN_MIN = 500
+
+    # Decode options for blackdetect. "fast" drops to 10fps before scaling to 160px wide and
+    # skips the deblocking loop filter; neither changes whether a frame reads as black.
+    # Keyframe-only decoding (-skip_frame nokey) is deliberately not used here since it
+    # misses black frames between keyframes. "coarse" also skips non-reference frames and
+    # samples at 5fps; it is only meant for finding candidates that refine_breaks then
+    # re-checks at full frame rate.
+    DETECT_PROFILES = {
+        "full": {"input_args": [], "video_filters": ""},
+        "fast": {"input_args": ["-skip_loop_filter", "all"], "video_filters": "fps=10,scale=160:-2,"},
+        "coarse": {"input_args": ["-skip_loop_filter", "all", "-skip_frame", "nonref"],
+                   "video_filters": "fps=5,scale=160:-2,"},
+    }
+
     @staticmethod
     def get_episode_name(db_config, episode_ids: list):
         query = f"""SELECT episode_id, episode_file, episode_airdate FROM episodes WHERE episode_id = ANY(%s);"""
-        conn = psycopg2.connect(**db_config)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute(query, (episode_ids,))
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
+        with db_connection(db_config) as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(query, (episode_ids,))
+            rows = cur.fetchall()
+            cur.close()
         return rows
 
 
     @staticmethod
     def get_show_name(db_config, show_id):
         query = f"""SELECT show_name FROM shows WHERE show_id = {show_id};"""
-        conn = psycopg2.connect(**db_config)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute(query)
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
+        with db_connection(db_config) as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(query)
+            row = cur.fetchone()
+            cur.close()
         return row['show_name']
 
     @staticmethod
@@ -119,12 +482,11 @@ class CommercialBreaks:
             WHERE s.show_id = {show_id}
             ORDER BY s.show_id, e.episode_id, cb.break_point;
         """
-        conn = psycopg2.connect(**db_config)
-        df = pd.read_sql_query(query, conn)
-        conn.close()
+        with db_connection(db_config) as conn:
+            df = pd.read_sql_query(query, conn)
 
         if df.empty:
-            return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+            return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
 
         # Derived fields
         df['break_duration'] = df['resume_point'] - df['break_point']
@@ -158,7 +520,8 @@ class CommercialBreaks:
         # --- 3. Average break midpoints ---
         avg_midpoints = (
             df.groupby(['show_id', 'break_index'])['break_midpoint']
-            .mean().reset_index(name='avg_break_midpoint')
+            .agg(avg_break_midpoint='mean', episodes='count')
+            .reset_index()
         )
 
         # Collect results
@@ -171,6 +534,26 @@ class CommercialBreaks:
 
         return episode_outliers, break_outliers, avg_midpoints, episode_outlier_breaks
 
+    @staticmethod
+    def get_break_priors(show_id: int, db_config: dict = None, min_episodes: int = 24) -> list[float]:
+        """
+        Expected break midpoints (seconds) for a show, from analyze_break_outliers.
+
+        Only break indexes seen in at least `min_episodes` episodes are returned, so
+        shows without enough detected history get [] and are scanned in full.
+        """
+        try:
+            # db_config None: the pool's default (DB_* environment), see db_connection
+            _, _, avg_midpoints, _ = CommercialBreaks.analyze_break_outliers(db_config, show_id)
+        except Exception as e:
+            print(f"Database query failed: {e}")
+            return []
+
+        if avg_midpoints.empty:
+            return []
+        priors = avg_midpoints[avg_midpoints['episodes'] >= min_episodes]
+        return sorted(priors['avg_break_midpoint'].tolist())
+
     @staticmethod
     def create_report(show_id: int, db_config: dict):
         episode_outliers, break_outliers, avg_breaks, episode_outlier_breaks = CommercialBreaks.analyze_break_outliers(db_config,show_id)
@@ -198,84 +581,482 @@ class CommercialBreaks:
                               'break_midpoint', 'avg_midpoint', 'std_midpoint', 'midpoint_z']])
 
     @staticmethod
-    def insert_commercial_break(episode_id: int, breaks=None):
+    def insert_commercial_break(episode_id: int, breaks=None, precision: int = 2):
         if breaks is None:
             breaks = []
 
-        db_config = {
-            'dbname': os.getenv("DB_NAME"),
-            'user': os.getenv("DB_USER"),
-            'password': os.getenv("DB_PASSWORD"),
-            'host': os.getenv("DB_HOST"),
-            'port': os.getenv("DB_PORT"),
-        }
-
+        # Replace, not append: a re-run for the same episode must not duplicate its breaks
+        delete_query = f"""DELETE FROM commercial_breaks WHERE media_id = %s;"""
         insert_query = f"""INSERT INTO commercial_breaks (media_id, break_point, resume_point) VALUES (%s, %s, %s);"""
-        data = [(episode_id, round(start,2), round(end, 2)) for start, end in breaks]
+        # Marks the episode scanned even with no breaks (migrations/002_breaks_scanned.sql)
+        scanned_query = f"""UPDATE episodes SET breaks_scanned_at = now() WHERE episode_id = %s;"""
+        data = [(episode_id, round(start, precision), round(end, precision)) for start, end in breaks]
 
         try:
-            conn = psycopg2.connect(**db_config)
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            cur.executemany(insert_query, data)
-            conn.commit()
-            cur.close()
-            conn.close()
+            with db_connection() as conn:
+                cur = conn.cursor(cursor_factory=RealDictCursor)
+                cur.execute(delete_query, (episode_id,))
+                cur.executemany(insert_query, data)
+                cur.execute(scanned_query, (episode_id,))
+                cur.close()
 
         except Exception as e:
-            print(f"Database query failed: {db_config}")
+            print(f"Database query failed: {e}")
             return None
 
     @staticmethod
-    def run_ffmpeg_blackdetect(video_path, duration: float = 0.8, threshold: float = 0.1):
-        """Extract black screen segments using ffmpeg."""
+    def insert_commercial_breaks_bulk(breaks_by_media: dict[int, list], precision: int = 2,
+                                      db_config: Optional[dict] = None) -> int:
+        """
+        Insert the breaks of many media ids with one multi-row INSERT, and mark every
+        one of them scanned, including those with no breaks.
+
+        Returns:
+            Number of rows inserted (0 on failure).
+        """
+        if not breaks_by_media:
+            return 0
+        data = [(media_id, round(start, precision), round(end, precision))
+                for media_id, breaks in breaks_by_media.items() for start, end in breaks]
+
+        insert_query = f"""INSERT INTO commercial_breaks (media_id, break_point, resume_point) VALUES %s;"""
+        scanned_query = f"""UPDATE episodes SET breaks_scanned_at = now() WHERE episode_id = ANY(%s);"""
+
+        try:
+            with db_connection(db_config) as conn:
+                cur = conn.cursor()
+                if data:
+                    execute_values(cur, insert_query, data, page_size=len(data))
+                cur.execute(scanned_query, (list(breaks_by_media),))
+                cur.close()
+            return len(data)
+
+        except Exception as e:
+            print(f"Database query failed: {e}")
+            return 0
+
+    @staticmethod
+    def run_ffmpeg_blackdetect(video_path, duration: float = 0.8, threshold: float = 0.1,
+                               profile: str = "full", on_progress=None, should_stop=None):
+        """Extract black screen segments using ffmpeg. `profile` selects an entry of DETECT_PROFILES."""
+        decode = CommercialBreaks.DETECT_PROFILES[profile]
         cmd = [
-            "ffmpeg", "-i", video_path,
-            "-vf", f"blackdetect=d={duration}:pix_th={threshold}",
+            "ffmpeg", *decode["input_args"], "-i", str(video_path),
+            "-vf", f"{decode['video_filters']}blackdetect=d={duration}:pix_th={threshold}",
             "-an", "-f", "null", "-"
         ]
-        result = subprocess.run(cmd, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
-        black_segments = []
-
-        for line in result.stderr.splitlines():
-            match = re.search(r"black_start:(\d+\.?\d*)\s+black_end:(\d+\.?\d*)", line)
-            if match:
-                black_segments.append((float(match.group(1)), float(match.group(2))))
+        runner = FFmpegRunner(cmd, on_progress=on_progress, should_stop=should_stop)
+        black_segments, _ = CommercialBreaks.parse_detect_output(runner.lines())
         return black_segments
 
     @staticmethod
-    def run_ffmpeg_silencedetect(video_path, db: float = 50, duration: float = 0.2):
+    def run_ffmpeg_silencedetect(video_path, db: float = 50, duration: float = 0.2,
+                                 on_progress=None, should_stop=None):
         """Extract silence segments using ffmpeg."""
         cmd = [
-            "ffmpeg", "-i", video_path,
+            "ffmpeg", "-i", str(video_path),
             "-af", f"silencedetect=n=-{db}dB:d={duration}",  # silence = below -50dB for 1 second
             "-f", "null", "-"
         ]
-        result = subprocess.run(cmd, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+        runner = FFmpegRunner(cmd, on_progress=on_progress, should_stop=should_stop)
+        _, silence_segments = CommercialBreaks.parse_detect_output(runner.lines())
+        return silence_segments
+
+    @staticmethod
+    def run_pcm_levels(video_path, window: float = 0.05, sample_rate: int = 8000,
+                       on_progress=None, should_stop=None) -> Optional[dict]:
+        """
+        Measure per-window audio levels from a mono s16le PCM pipe (no video decode).
+
+        Samples are folded into fixed windows as they arrive, so only the current
+        partial window is buffered. One read can serve several analyses, e.g.
+        silence_from_levels at different thresholds.
+
+        Returns:
+            {"window": seconds, "rms_db": ndarray, "peak_db": ndarray, "integrated_db": float}
+            with levels in dBFS, or None if ffmpeg failed or was aborted. integrated_db
+            is the mean energy of windows above -70 dBFS.
+        """
+        meter = PcmLevelMeter(sample_rate=sample_rate, window=window)
+        cmd = [
+            "ffmpeg", "-hide_banner", "-i", str(video_path),
+            "-vn", "-sn", "-dn", "-ac", "1", "-ar", str(sample_rate),
+            "-c:a", "pcm_s16le", "-f", "s16le", "pipe:1"
+        ]
+        runner = FFmpegRunner(cmd, on_progress=on_progress, should_stop=should_stop, on_data=meter.feed)
+        stderr = runner.run()
+        if runner.aborted or runner.returncode != 0:
+            print(f"[ERROR] PCM read failed for {video_path}: {stderr[-5:]}")
+            return None
+        return meter.levels()
+
+    @staticmethod
+    def silence_from_levels(levels: dict, db: float = 50, duration: float = 0.2) -> list[tuple[float, float]]:
+        """Runs of windows with RMS below -`db` dBFS lasting at least `duration` seconds."""
+        window = levels["window"]
+        silent = np.r_[False, levels["rms_db"] < -db, False].astype(np.int8)
+        edges = np.diff(silent)
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        return [
+            (round(start * window, 3), round(end * window, 3))
+            for start, end in zip(starts.tolist(), ends.tolist())
+            if (end - start) * window >= duration
+        ]
+
+    @staticmethod
+    def run_pcm_silencedetect(video_path, db: float = 50, duration: float = 0.2, window: float = 0.05,
+                              on_progress=None, should_stop=None) -> list[tuple[float, float]]:
+        """
+        Audio-only alternative to run_ffmpeg_silencedetect using windowed RMS.
+
+        Silence is judged on `window`-second RMS rather than per sample, so very short
+        clicks inside a quiet stretch no longer split it.
+        """
+        levels = CommercialBreaks.run_pcm_levels(video_path, window=window, on_progress=on_progress,
+                                                 should_stop=should_stop)
+        if levels is None:
+            return []
+        return CommercialBreaks.silence_from_levels(levels, db, duration)
+
+    @staticmethod
+    def run_ffmpeg_detect(video_path, black_duration: float = 0.8, black_threshold: float = 0.1,
+                          db: float = 50, silence_duration: float = 0.2, start: Optional[float] = None,
+                          length: Optional[float] = None, profile: str = "full",
+                          on_progress=None, should_stop=None) -> tuple[list, list]:
+        """
+        Extract black and silence segments from a single ffmpeg decode.
+
+        Runs blackdetect on the video stream and silencedetect on the audio stream
+        in one invocation, so the file is only read once. If `should_stop` aborts
+        the run, the segments found up to that point are returned.
+
+        `start`/`length` limit the scan to a slice of the file using input seeking;
+        returned timestamps are still relative to the start of the file. `profile`
+        selects the video decode options from DETECT_PROFILES.
+
+        Returns:
+            (black_segments, silence_segments) in the same format as
+            run_ffmpeg_blackdetect / run_ffmpeg_silencedetect.
+        """
+        decode = CommercialBreaks.DETECT_PROFILES[profile]
+        cmd = ["ffmpeg", *decode["input_args"]]
+        if start:
+            cmd.extend(["-ss", f"{start:.3f}"])
+        if length is not None:
+            cmd.extend(["-t", f"{length:.3f}"])
+        cmd.extend([
+            "-i", str(video_path),
+            "-vf", f"{decode['video_filters']}blackdetect=d={black_duration}:pix_th={black_threshold}",
+            "-af", f"silencedetect=n=-{db}dB:d={silence_duration}",
+            "-f", "null", "-"
+        ])
+        runner = FFmpegRunner(cmd, duration=length, on_progress=on_progress, should_stop=should_stop)
+        black, silence = CommercialBreaks.parse_detect_output(runner.lines())
+
+        if start:
+            black = [(b_start + start, b_end + start) for b_start, b_end in black]
+            silence = [(s_start + start, s_end + start) for s_start, s_end in silence]
+        return black, silence
+
+    @staticmethod
+    def shard_ranges(total_duration: float, shards: int, overlap: float = 30.0) -> list[tuple[float, float]]:
+        """
+        Split [0, total_duration] into `shards` (start, length) slices.
+
+        Each slice runs `overlap` seconds into the next one, so any black or silence
+        run shorter than the overlap is seen whole by at least one shard.
+        """
+        shards = max(1, shards)
+        core = total_duration / shards
+        return [
+            (i * core, min(core + overlap, total_duration - i * core))
+            for i in range(shards)
+        ]
+
+    @staticmethod
+    def run_ffmpeg_detect_sharded(video_path, shards: int, overlap: float = 30.0,
+                                  min_shard_length: float = 900.0, duration: Optional[float] = None,
+                                  on_progress=None, should_stop=None, **detect_kwargs) -> tuple[list, list]:
+        """
+        Run run_ffmpeg_detect over overlapping time shards in parallel and stitch the results.
+
+        The shard count is capped so every shard covers at least `min_shard_length`
+        seconds; a 25 minute episode stays a single scan, a movie uses up to
+        `shards` ffmpeg processes. Shards run from a thread pool since each one is
+        its own ffmpeg process (Celery prefork children can't start a process pool).
+        Segments from overlapping shards are unioned, which rejoins runs cut at a
+        shard boundary and drops duplicates from the overlap.
+
+        Returns:
+            (black_segments, silence_segments), same as run_ffmpeg_detect.
+        """
+        if duration is None:
+            duration = float(VideoReProcess.get_metadata(str(video_path))["format"]["duration"])
+
+        shards = min(shards, max(1, int(duration // min_shard_length)))
+        if shards <= 1:
+            return CommercialBreaks.run_ffmpeg_detect(video_path, on_progress=on_progress,
+                                                      should_stop=should_stop, **detect_kwargs)
+
+        ranges = CommercialBreaks.shard_ranges(duration, shards, overlap)
+        total_length = sum(length for _, length in ranges)
+        covered = {}
+        lock = threading.Lock()
+
+        def shard_progress(index: int, length: float):
+            if on_progress is None:
+                return None
+
+            def report(progress: dict) -> None:
+                with lock:
+                    covered[index] = min(progress["out_time"], length)
+                    on_progress({
+                        "percent": round(min(100.0, sum(covered.values()) / total_length * 100), 1),
+                        "eta": None,
+                        "fps": progress["fps"],
+                        "speed": progress["speed"],
+                        "out_time": round(sum(covered.values()), 2),
+                        "shards": len(ranges),
+                    })
+            return report
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            futures = [
+                pool.submit(CommercialBreaks.run_ffmpeg_detect, video_path, start=start, length=length,
+                            on_progress=shard_progress(i, length), should_stop=should_stop, **detect_kwargs)
+                for i, (start, length) in enumerate(ranges)
+            ]
+            results = [future.result() for future in futures]
+
+        black = CommercialBreaks.stitch_shard_segments([seg for shard_black, _ in results for seg in shard_black])
+        silence = CommercialBreaks.stitch_shard_segments([seg for _, shard_silence in results for seg in shard_silence])
+        return black, silence
+
+    @staticmethod
+    def run_ffmpeg_detect_windowed(video_path, midpoints: list[float], window: float = 180.0,
+                                   duration: Optional[float] = None, on_progress=None, should_stop=None,
+                                   **detect_kwargs) -> Optional[tuple[list, list]]:
+        """
+        Run run_ffmpeg_detect only in windows of +/- `window` seconds around expected breaks.
+
+        Overlapping windows are combined and each is decoded with input seeking.
+        Returns None if any window produces no break candidate (or the scan is
+        aborted), meaning the priors don't fit this file and it needs a full scan.
+        """
+        if duration is None:
+            duration = float(VideoReProcess.get_metadata(str(video_path))["format"]["duration"])
+
+        windows = CommercialBreaks.merge_close_segments(
+            [(max(0.0, m - window), min(duration, m + window)) for m in midpoints if 0 <= m <= duration],
+            max_gap=0.0
+        )
+        if not windows:
+            return None
+
+        total_length = sum(end - start for start, end in windows)
+        covered = 0.0
+        black, silence = [], []
+        for start, end in windows:
+            report = None
+            if on_progress is not None:
+                def report(progress, offset=covered):
+                    out_time = offset + progress["out_time"]
+                    on_progress({**progress, "percent": round(min(100.0, out_time / total_length * 100), 1),
+                                 "eta": None, "out_time": round(out_time, 2)})
+
+            window_black, window_silence = CommercialBreaks.run_ffmpeg_detect(
+                video_path, start=start, length=end - start, on_progress=report, should_stop=should_stop,
+                **detect_kwargs
+            )
+            if should_stop is not None and should_stop():
+                return None
+            if not CommercialBreaks.merge_segments(window_black, window_silence):
+                print(f"[INFO] No break near {CommercialBreaks.format_time((start + end) / 2)} in {video_path}")
+                return None
+
+            black.extend(window_black)
+            silence.extend(window_silence)
+            covered += end - start
+        return black, silence
+
+    @staticmethod
+    def refine_breaks(video_path, candidates, pad: float = 2.0, should_stop=None, **detect_kwargs):
+        """
+        Snap coarse break candidates to frame accuracy.
+
+        Each candidate is re-scanned at full resolution and frame rate from `pad`
+        seconds before to `pad` seconds after it, and replaced by the merged
+        black+silence segments found there. Candidates whose window finds nothing
+        are kept as they were.
+        """
+        refined = []
+        for c_start, c_end in candidates:
+            start = max(0.0, c_start - pad)
+            black, silence = CommercialBreaks.run_ffmpeg_detect(
+                video_path, start=start, length=c_end + pad - start, profile="full",
+                should_stop=should_stop, **detect_kwargs
+            )
+            matches = [
+                seg for seg in CommercialBreaks.merge_segments(black, silence)
+                if seg[0] <= c_end and seg[1] >= c_start
+            ]
+            if matches:
+                refined.append((matches[0][0], matches[-1][1]))
+            else:
+                refined.append((c_start, c_end))
+        return CommercialBreaks.merge_close_segments(refined, max_gap=0.0)
+
+    @staticmethod
+    def stitch_shard_segments(segments, epsilon: float = 0.05):
+        """Union segments reported by overlapping shards; `epsilon` absorbs small timestamp jitter between shards."""
+        return CommercialBreaks.merge_close_segments(list(segments), max_gap=epsilon)
+
+    @staticmethod
+    def validate_detect_profile(video_paths: list, profile: str = "fast", baseline: str = "full",
+                                tolerance: float = 0.5) -> pd.DataFrame:
+        """
+        Compare the breaks found with `profile` against `baseline` on a sample set.
+
+        A baseline break counts as matched when a profile break starts and ends within
+        `tolerance` seconds of it. Returns one row per file with matched/missed/extra
+        counts, the largest boundary drift and the wall-clock speedup.
+        """
+        rows = []
+        for video_path in video_paths:
+            timings = {}
+            breaks = {}
+            for name in (baseline, profile):
+                started = time.monotonic()
+                black, silence = CommercialBreaks.run_ffmpeg_detect(video_path, profile=name)
+                timings[name] = time.monotonic() - started
+                breaks[name] = CommercialBreaks.merge_segments(black, silence)
+
+            matched, drift = 0, 0.0
+            remaining = list(breaks[profile])
+            for b_start, b_end in breaks[baseline]:
+                for candidate in remaining:
+                    if abs(candidate[0] - b_start) <= tolerance and abs(candidate[1] - b_end) <= tolerance:
+                        drift = max(drift, abs(candidate[0] - b_start), abs(candidate[1] - b_end))
+                        remaining.remove(candidate)
+                        matched += 1
+                        break
+
+            rows.append({
+                "file": str(video_path),
+                "baseline_breaks": len(breaks[baseline]),
+                "matched": matched,
+                "missed": len(breaks[baseline]) - matched,
+                "extra": len(remaining),
+                "max_drift": round(drift, 3),
+                "speedup": round(timings[baseline] / timings[profile], 2) if timings[profile] else None,
+            })
+        return pd.DataFrame(rows)
+
+    @staticmethod
+    def parse_detect_output(lines) -> tuple[list, list]:
+        """Parse blackdetect and silencedetect events from ffmpeg stderr lines, consumed as they arrive."""
+        black_segments = []
         silence_segments = []
         start = None
 
-        for line in result.stderr.splitlines():
-            if "silence_start" in line:
+        for line in lines:
+            match = re.search(r"black_start:(\d+\.?\d*)\s+black_end:(\d+\.?\d*)", line)
+            if match:
+                black_segments.append((float(match.group(1)), float(match.group(2))))
+            elif "silence_start" in line:
                 start = float(line.split("silence_start: ")[1])
             elif "silence_end" in line and start is not None:
                 end = float(line.split("silence_end: ")[1].split()[0])
                 silence_segments.append((start, end))
                 start = None
-        return silence_segments
+        return black_segments, silence_segments
 
     @staticmethod
-    def merge_segments(black, silence, tolerance=1.0):
-        """Find overlapping or close black+silence segments."""
+    def merge_segments(black, silence, tolerance=1.0, max_gap=1.0):
+        """
+        Find overlapping or close black+silence segments.
+
+        A black and a silence segment match when they overlap, or when one ends
+        within `tolerance` seconds of the other starting. Instead of testing every
+        pair, silences are sorted once and each black segment is only checked
+        against the silences that can reach it. Every black segment contributes a
+        single candidate spanning all of its matches, which merge_close_segments
+        collapses exactly as it would the individual pairs.
+        """
+        if not black or not silence:
+            return []
+
+        if len(black) + len(silence) >= CommercialBreaks.NUMPY_JOIN_MIN:
+            commercials = CommercialBreaks._join_segments_numpy(black, silence, tolerance)
+        else:
+            commercials = CommercialBreaks._join_segments_sweep(black, silence, tolerance)
+        return CommercialBreaks.merge_close_segments(commercials, max_gap=max_gap)
+
+    @staticmethod
+    def _segments_match(b_start, b_end, s_start, s_end, tolerance) -> bool:
+        overlap = min(b_end, s_end) - max(b_start, s_start)
+        return overlap >= 0 or abs(b_end - s_start) <= tolerance or abs(s_end - b_start) <= tolerance
+
+    @staticmethod
+    def _join_segments_sweep(black, silence, tolerance):
+        """Pure Python interval join; returns one (start, end) hull per matched black segment."""
+        silence = sorted(silence)
+        starts = [s_start for s_start, _ in silence]
+        # Running max of silence ends, so bisect can skip silences that end too early
+        reach = list(accumulate((s_end for _, s_end in silence), max))
+        # Widen the search window slightly; the exact predicate still decides
+        pad = tolerance + 1e-6
+
         commercials = []
         for b_start, b_end in black:
-            for s_start, s_end in silence:
-                latest_start = max(b_start, s_start)
-                earliest_end = min(b_end, s_end)
-                overlap = earliest_end - latest_start
+            lo = bisect_left(reach, b_start - pad)
+            hi = bisect_right(starts, b_end + pad)
+            hull = None
+            for s_start, s_end in silence[lo:hi]:
+                if not CommercialBreaks._segments_match(b_start, b_end, s_start, s_end, tolerance):
+                    continue
+                if hull is None:
+                    hull = (min(b_start, s_start), max(b_end, s_end))
+                else:
+                    hull = (min(hull[0], s_start), max(hull[1], s_end))
+            if hull is not None:
+                commercials.append(hull)
+        return commercials
+
+    @staticmethod
+    def _join_segments_numpy(black, silence, tolerance):
+        """Vectorized interval join for large segment lists; same result as _join_segments_sweep."""
+        blk = np.asarray(black, dtype=np.float64).reshape(-1, 2)
+        sil = np.asarray(sorted(silence), dtype=np.float64).reshape(-1, 2)
+        reach = np.maximum.accumulate(sil[:, 1])
+        pad = tolerance + 1e-6
+
+        lo = np.searchsorted(reach, blk[:, 0] - pad, side="left")
+        hi = np.searchsorted(sil[:, 0], blk[:, 1] + pad, side="right")
+        counts = np.clip(hi - lo, 0, None)
+        total = int(counts.sum())
+        if total == 0:
+            return []
+
+        # Expand each black segment's [lo, hi) window into flat (black, silence) pairs
+        b_idx = np.repeat(np.arange(len(blk)), counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        s_idx = np.repeat(lo, counts) + offsets
+
+        b_start, b_end = blk[b_idx, 0], blk[b_idx, 1]
+        s_start, s_end = sil[s_idx, 0], sil[s_idx, 1]
+        overlap = np.minimum(b_end, s_end) - np.maximum(b_start, s_start)
+        match = (overlap >= 0) | (np.abs(b_end - s_start) <= tolerance) | (np.abs(s_end - b_start) <= tolerance)
+        if not match.any():
+            return []
 
-                if overlap >= 0 or abs(b_end - s_start) <= tolerance or abs(s_end - b_start) <= tolerance:
-                    commercials.append((min(b_start, s_start), max(b_end, s_end)))
-        return CommercialBreaks.merge_close_segments(commercials)
+        b_idx, s_start, s_end = b_idx[match], s_start[match], s_end[match]
+        firsts = np.flatnonzero(np.r_[True, b_idx[1:] != b_idx[:-1]])
+        owners = b_idx[firsts]
+        hull_start = np.minimum(blk[owners, 0], np.minimum.reduceat(s_start, firsts))
+        hull_end = np.maximum(blk[owners, 1], np.maximum.reduceat(s_end, firsts))
+        return list(zip(hull_start.tolist(), hull_end.tolist()))
 
     @staticmethod
     def merge_close_segments(segments, max_gap=1.0):
@@ -294,6 +1075,236 @@ class CommercialBreaks:
                 merged.append(current)
         return merged
 
+    @staticmethod
+    def run_ffmpeg_detect_raw(video_path, thresholds: list[float], dbs: list[float],
+                              silence_duration: float = 0.1, on_progress=None, should_stop=None) -> Optional[dict]:
+        """
+        Collect raw black and silence runs for several thresholds from one decode.
+
+        The video is split into one blackdetect branch per `thresholds` value and the
+        audio into one silencedetect branch per `dbs` value. Each branch prints its
+        frame metadata to its own file, which records every black run regardless of
+        duration, and every silence of at least `silence_duration` seconds. Stricter
+        duration limits can then be applied in memory (see sweep_detection_params).
+
+        Returns:
+            {"black": [[threshold, [(start, end), ...]], ...],
+             "silence": [[db, [(start, end), ...]], ...]}
+            or None if ffmpeg failed or was aborted.
+        """
+        with tempfile.TemporaryDirectory(prefix="detect_raw_") as tmp_dir:
+            black_files = [f"{tmp_dir}/black_{i}.txt" for i in range(len(thresholds))]
+            silence_files = [f"{tmp_dir}/silence_{i}.txt" for i in range(len(dbs))]
+
+            video_labels = "".join(f"[v{i}]" for i in range(len(thresholds)))
+            audio_labels = "".join(f"[a{i}]" for i in range(len(dbs)))
+            chains = [f"[0:v]split={len(thresholds)}{video_labels}", f"[0:a]asplit={len(dbs)}{audio_labels}"]
+            chains += [
+                f"[v{i}]blackdetect=d=0:pix_th={threshold},metadata=mode=print:file={black_files[i]}[bo{i}]"
+                for i, threshold in enumerate(thresholds)
+            ]
+            chains += [
+                f"[a{i}]silencedetect=n=-{db}dB:d={silence_duration},ametadata=mode=print:file={silence_files[i]}[so{i}]"
+                for i, db in enumerate(dbs)
+            ]
+
+            cmd = ["ffmpeg", "-v", "error", "-i", str(video_path), "-filter_complex", ";".join(chains)]
+            for i in range(len(thresholds)):
+                cmd.extend(["-map", f"[bo{i}]"])
+            for i in range(len(dbs)):
+                cmd.extend(["-map", f"[so{i}]"])
+            cmd.extend(["-f", "null", "-"])
+
+            runner = FFmpegRunner(cmd, on_progress=on_progress, should_stop=should_stop)
+            errors = runner.run()
+            if runner.aborted or runner.returncode != 0:
+                print(f"[ERROR] Raw detection failed for {video_path}: {errors[:5]}")
+                return None
+
+            # Runs still open when the file ends (e.g. black end credits) close at its duration
+            return {
+                "black": [
+                    [threshold, CommercialBreaks._parse_metadata_runs(path, "lavfi.black_start", "lavfi.black_end",
+                                                                      runner.duration)]
+                    for threshold, path in zip(thresholds, black_files)
+                ],
+                "silence": [
+                    [db, CommercialBreaks._parse_metadata_runs(path, "lavfi.silence_start", "lavfi.silence_end",
+                                                               runner.duration)]
+                    for db, path in zip(dbs, silence_files)
+                ],
+            }
+
+    @staticmethod
+    def _parse_metadata_runs(path: str, start_key: str, end_key: str,
+                             end: Optional[float] = None) -> list[tuple[float, float]]:
+        """Pair up start/end keys from a metadata=mode=print file; a run still open at EOF ends at `end`."""
+        runs = []
+        start = None
+        if not os.path.exists(path):
+            return runs
+        with open(path, "r") as f:
+            for line in f:
+                key, _, value = line.strip().partition("=")
+                if key == start_key:
+                    start = float(value)
+                elif key == end_key and start is not None:
+                    runs.append((start, float(value)))
+                    start = None
+        if start is not None and end is not None and end > start:
+            runs.append((start, end))
+        return runs
+
+    @staticmethod
+    def sweep_detection_params(episodes: list[dict], grid: dict[str, list], reference: dict = None,
+                               expected_breaks: Optional[int] = None, match_tolerance: float = 2.0) -> pd.DataFrame:
+        """
+        Score every parameter combination in `grid` against cached raw detections.
+
+        For each episode and (black_threshold, db) pair, every black_duration,
+        silence_duration, tolerance and max_gap combination is evaluated at once
+        in NumPy (see _sweep_breaks), with the same result as running
+        merge_segments and filter_edges on each combination.
+
+        Args:
+            episodes: [{"episode_id", "raw", "start_point", "end_point"}], with "raw" from
+                      run_ffmpeg_detect_raw.
+            grid: Lists of values for "black_threshold", "black_duration", "db",
+                  "silence_duration", "tolerance" and "max_gap". Thresholds and dBs must
+                  be ones the raw detections were collected at.
+            reference: Optional {episode_id: [(break_point, resume_point), ...]} of known
+                       good breaks; combinations are scored by mean F1 against it.
+            expected_breaks: Used when there is no reference; the score is the share of
+                             episodes with exactly this many breaks.
+            match_tolerance: Max midpoint distance (seconds) for a break to match the reference.
+
+        Returns:
+            DataFrame with one row per combination and its score, best first.
+        """
+        keys = ["black_threshold", "black_duration", "db", "silence_duration", "tolerance", "max_gap"]
+        combos = list(itertools.product(*(grid[k] for k in keys)))
+        # Same axis order as `combos`, so the flattened array lines up with it
+        scores = np.zeros([len(grid[k]) for k in keys])
+        black_durations, silence_durations, tolerances, gaps = (
+            np.asarray(grid[k], dtype=np.float64) for k in ("black_duration", "silence_duration", "tolerance", "max_gap"))
+
+        for episode in episodes:
+            raw_black = {threshold: np.asarray(segs, dtype=np.float64).reshape(-1, 2)
+                         for threshold, segs in episode["raw"]["black"]}
+            raw_silence = {db: np.asarray(segs, dtype=np.float64).reshape(-1, 2)
+                           for db, segs in episode["raw"]["silence"]}
+            expected = reference.get(episode["episode_id"]) if reference else None
+
+            for (ti, threshold), (di, db) in itertools.product(enumerate(grid["black_threshold"]),
+                                                                enumerate(grid["db"])):
+                starts, ends, keep = CommercialBreaks._sweep_breaks(
+                    raw_black[threshold], raw_silence[db], black_durations, silence_durations, tolerances, gaps,
+                    episode["start_point"], episode["end_point"])
+                if reference:
+                    # Greedy matching doesn't vectorize; the breaks themselves already are
+                    block = np.zeros(keep.shape[:-1])
+                    for index in np.ndindex(block.shape):
+                        found = list(zip(starts[index][keep[index]], ends[index][keep[index]]))
+                        block[index] = CommercialBreaks._break_f1(found, expected or [], match_tolerance)
+                elif expected_breaks is not None:
+                    block = keep.sum(axis=-1) == expected_breaks
+                else:
+                    continue
+                scores[ti, :, di] += block
+
+        results = pd.DataFrame(combos, columns=keys)
+        results["score"] = scores.ravel() / max(len(episodes), 1)
+        return results.sort_values("score", ascending=False, kind="stable").reset_index(drop=True)
+
+    @staticmethod
+    def _sweep_breaks(black: np.ndarray, silence: np.ndarray, black_durations: np.ndarray,
+                      silence_durations: np.ndarray, tolerances: np.ndarray, gaps: np.ndarray,
+                      start_point: float = 0.0, end_point: Optional[float] = None,
+                      epsilon: float = 0.2) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        merge_segments + filter_edges for every (black_duration, silence_duration,
+        tolerance, max_gap) combination at once, from raw (n, 2) black and silence runs.
+
+        Candidate (black, silence) pairs are windowed once for the widest tolerance;
+        duration limits and tolerances then become boolean masks over those pairs,
+        hulls are per-black reductions, and merging sorted hulls closer than max_gap
+        is a running max of their ends.
+
+        Returns:
+            (starts, ends, keep), each shaped (black_durations, silence_durations,
+            tolerances, gaps, n). A combination's breaks are (starts[..., i], ends[..., i])
+            for every i where keep[..., i].
+        """
+        shape = (len(black_durations), len(silence_durations), len(tolerances), len(gaps))
+        if not len(black) or not len(silence):
+            return np.zeros(shape + (0,)), np.zeros(shape + (0,)), np.zeros(shape + (0,), dtype=bool)
+
+        sil = silence[np.argsort(silence[:, 0], kind="stable")]
+        reach = np.maximum.accumulate(sil[:, 1])
+        pad = float(tolerances.max()) + 1e-6
+        lo = np.searchsorted(reach, black[:, 0] - pad, side="left")
+        hi = np.searchsorted(sil[:, 0], black[:, 1] + pad, side="right")
+        counts = np.clip(hi - lo, 0, None)
+        total = int(counts.sum())
+        if total == 0:
+            return np.zeros(shape + (0,)), np.zeros(shape + (0,)), np.zeros(shape + (0,), dtype=bool)
+
+        # Flat (black, silence) candidate pairs, grouped by black run
+        b_idx = np.repeat(np.arange(len(black)), counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        s_idx = np.repeat(lo, counts) + offsets
+        b_start, b_end = black[b_idx, 0], black[b_idx, 1]
+        s_start, s_end = sil[s_idx, 0], sil[s_idx, 1]
+        overlap = np.minimum(b_end, s_end) - np.maximum(b_start, s_start)
+        distance = np.minimum(np.abs(b_end - s_start), np.abs(s_end - b_start))
+
+        b_keep = (black[:, 1] - black[:, 0])[None, :] >= black_durations[:, None]
+        s_keep = (sil[:, 1] - sil[:, 0])[None, :] >= silence_durations[:, None]
+        pair_match = (overlap >= 0)[None, :] | (distance[None, :] <= tolerances[:, None])
+        # (black_durations, silence_durations, tolerances, pairs)
+        match = b_keep[:, b_idx][:, None, None, :] & s_keep[:, s_idx][None, :, None, :] & pair_match[None, None]
+
+        # One hull per black run with any match
+        firsts = np.flatnonzero(np.r_[True, b_idx[1:] != b_idx[:-1]])
+        owners = b_idx[firsts]
+        matched = np.logical_or.reduceat(match, firsts, axis=-1)
+        hull_start = np.minimum(black[owners, 0], np.minimum.reduceat(np.where(match, s_start, np.inf), firsts, axis=-1))
+        hull_end = np.maximum(black[owners, 1], np.maximum.reduceat(np.where(match, s_end, -np.inf), firsts, axis=-1))
+        hull_start = np.where(matched, hull_start, np.inf)
+        hull_end = np.where(matched, hull_end, -np.inf)
+
+        # Sort hulls (unmatched ones last) and merge: a hull opens a new break when it starts
+        # more than max_gap after the furthest end so far
+        order = np.argsort(hull_start, axis=-1, kind="stable")
+        starts = np.take_along_axis(hull_start, order, axis=-1)[..., None, :]
+        ends = np.maximum.accumulate(np.take_along_axis(hull_end, order, axis=-1), axis=-1)[..., None, :]
+        valid = np.isfinite(starts)
+        previous_end = np.concatenate([np.full(ends.shape[:-1] + (1,), -np.inf), ends[..., :-1]], axis=-1)
+        opens = valid & (starts - previous_end > gaps[:, None])
+        break_start = np.maximum.accumulate(np.where(opens, starts, -np.inf), axis=-1)
+        # A break ends at its last hull: the next one opens a new break or there is none
+        closes = valid & ~np.concatenate([valid[..., 1:] & ~opens[..., 1:], np.zeros(opens.shape[:-1] + (1,), dtype=bool)],
+                                         axis=-1)
+
+        keep = closes & (break_start > start_point + epsilon)
+        if end_point is not None:
+            keep &= ends < end_point - epsilon
+        return np.broadcast_to(break_start, keep.shape), np.broadcast_to(ends, keep.shape), keep
+
+    @staticmethod
+    def _break_f1(found, expected, match_tolerance: float) -> float:
+        if not found and not expected:
+            return 1.0
+        found_mid = [(start + end) / 2 for start, end in found]
+        matched = 0
+        for start, end in expected:
+            mid = (start + end) / 2
+            nearest = min(found_mid, key=lambda m: abs(m - mid), default=None)
+            if nearest is not None and abs(nearest - mid) <= match_tolerance:
+                found_mid.remove(nearest)
+                matched += 1
+        return 2 * matched / (len(found) + len(expected))
+
     @staticmethod
     def filter_edges(segments, start_point=0.0, end_point=None, epsilon=0.2):
         """
@@ -323,8 +1334,123 @@ class CommercialBreaks:
         return f"{int(seconds // 3600):02}:{int((seconds % 3600) // 60):02}:{seconds % 60:06.3f}"
 
 
+class ReprocessCheckpoint:
+    """
+    Per-source checkpoints for VideoReProcess.reprocess, kept as JSON in
+    REPROCESS_CHECKPOINT_DIR (by default on the library volume, DIR_ROOT_PI).
+
+    A checkpoint records the last finished stage and what it produced (crop,
+    loudness, size of the encoded file). The temp file next to the source is
+    named from a hash of the source path, so a redelivered task finds it again,
+    on whichever host it lands, as long as the directory is shared like the
+    library. lock() keeps two workers off the same source; clear() removes the
+    checkpoint together with the temp file, and clear_stale() sweeps up after
+    workers that died and were never retried.
+    """
+
+    CHECKPOINT_DIR = os.getenv("REPROCESS_CHECKPOINT_DIR") or (
+        f"{os.getenv('DIR_ROOT_PI')}/.reprocess_checkpoints" if os.getenv("DIR_ROOT_PI")
+        else "/tmp/reprocess_checkpoints")
+
+    @staticmethod
+    def _key(input_file: str) -> str:
+        return hashlib.sha1(os.path.abspath(input_file).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def temp_file_name(input_file: str) -> str:
+        return f"TEMP_{ReprocessCheckpoint._key(input_file)}.mp4"
+
+    @staticmethod
+    def _path(input_file: str) -> str:
+        return f"{ReprocessCheckpoint.CHECKPOINT_DIR}/{ReprocessCheckpoint._key(input_file)}.json"
+
+    @staticmethod
+    @contextlib.contextmanager
+    def lock(input_file: str):
+        """
+        Exclusive lock on `input_file` for the block (flock on a file next to its
+        checkpoint). Raises BlockingIOError at once if another worker holds it.
+        """
+        os.makedirs(ReprocessCheckpoint.CHECKPOINT_DIR, exist_ok=True)
+        lock_path = f"{ReprocessCheckpoint.CHECKPOINT_DIR}/{ReprocessCheckpoint._key(input_file)}.lock"
+        with open(lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def load(input_file: str) -> dict:
+        try:
+            with open(ReprocessCheckpoint._path(input_file), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def save(input_file: str, state: dict) -> None:
+        os.makedirs(ReprocessCheckpoint.CHECKPOINT_DIR, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=ReprocessCheckpoint.CHECKPOINT_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(temp_path, ReprocessCheckpoint._path(input_file))
+
+    @staticmethod
+    def clear(input_file: str) -> None:
+        """Drop the checkpoint and every temp file it refers to."""
+        temp_file_name = ReprocessCheckpoint.temp_file_name(input_file)
+        for path in (f"{Path(input_file).parent}/{temp_file_name}", ReprocessCheckpoint._path(input_file)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def clear_stale(max_age: float) -> int:
+        """
+        Clear checkpoints (and their temp files) not updated for `max_age` seconds,
+        and old lock files. Checkpoints whose lock a worker holds are left alone
+        however old they are. Returns how many checkpoints were cleared.
+        """
+        cleared = 0
+        if not os.path.isdir(ReprocessCheckpoint.CHECKPOINT_DIR):
+            return cleared
+        cutoff = time.time() - max_age
+        for entry in os.scandir(ReprocessCheckpoint.CHECKPOINT_DIR):
+            key, ext = os.path.splitext(entry.name)
+            lock_path = f"{ReprocessCheckpoint.CHECKPOINT_DIR}/{key}.lock"
+            try:
+                if ext not in (".json", ".lock") or entry.stat().st_mtime > cutoff:
+                    continue
+                with open(lock_path, "a") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    if ext == ".json":
+                        with open(entry.path, "r") as f:
+                            input_file = json.load(f).get("input_file")
+                        if input_file:
+                            ReprocessCheckpoint.clear(input_file)
+                        if os.path.exists(entry.path):
+                            os.remove(entry.path)
+                        cleared += 1
+                    os.remove(lock_path)
+            except BlockingIOError:
+                continue
+            except (OSError, ValueError) as e:
+                print(f"[WARN] Could not clear stale checkpoint {entry.path}: {e}")
+        return cleared
+
+    @staticmethod
+    def file_matches(path: str, size: Optional[int]) -> bool:
+        """True if `path` is the complete file a checkpoint recorded with `size`."""
+        return size is not None and os.path.exists(path) and os.path.getsize(path) == size
+
+
 class VideoReProcess:
 
+    LOUDNORM_TARGET = "I=-26:TP=-2:LRA=7"
+    CHUNKED_MIN_DURATION = 3000
+    # Max seconds the joined chunks may differ from the audio before the chunked encode is discarded
+    CHUNKED_MAX_DRIFT = 0.5
+
     @staticmethod
     def get_video_length(filename: str) -> Optional[float]:
         """Return video duration in seconds, or None if not available."""
@@ -401,6 +1527,11 @@ class VideoReProcess:
         result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
         return json.loads(result.stdout)
 
+    @staticmethod
+    def probe_duration(file_path: str) -> float:
+        """Container duration in seconds from ffprobe, 0.0 if it has none."""
+        return float(VideoReProcess.get_metadata(file_path).get("format", {}).get("duration", 0) or 0)
+
     @staticmethod
     def get_random_filename():
         return VideoReProcess._random_filename()
@@ -413,27 +1544,88 @@ class VideoReProcess:
         return f"TEMP_{name}.mp4"
 
     @staticmethod
-    def update_video_metadata(input_file: str, metadata: dict[str, str]) -> bool:
+    def swap_in(temp_file: str, input_file: str, keep_backup: bool = True, backup_done: bool = False,
+                on_backup=None) -> None:
+        """
+        Atomically replace `input_file` with `temp_file` from the same directory.
+        With `keep_backup` the original is kept as OLD_<name> (replacing any older
+        backup), hard-linked first so `input_file` never goes missing (renamed where
+        links aren't supported), and `on_backup` is called once it exists.
+        `backup_done` skips the backup: a resumed swap whose first attempt already
+        recorded it (via `on_backup`) must not back up the file again.
+        """
+        if keep_backup and not backup_done and os.path.exists(input_file):
+            backup = f"{Path(input_file).parent}/OLD_{Path(input_file).name}"
+            try:
+                if os.path.exists(backup):
+                    os.remove(backup)
+                os.link(input_file, backup)
+            except OSError:
+                os.rename(input_file, backup)
+            if on_backup is not None:
+                on_backup()
+        os.replace(temp_file, input_file)
+
+    @staticmethod
+    def update_video_metadata(input_file: str, metadata: dict[str, str], keep_backup: bool = True) -> bool:
         """
         Clears existing metadata in a video file and replaces it with custom metadata.
 
+        MP4s are retagged in place with Mp4MetadataEditor (only the moov box is
+        rewritten) and checked with ffprobe; other layouts, unsupported keys or a
+        failed check fall back to remuxing with `-c copy`. The retag's undo record is
+        kept in a META_*.undo sidecar until the check passes: a failed check restores
+        the original bytes, and so does the next call after a crash mid-retag.
+
         Args:
             input_file (str): Path to the source video file.
             output_file (str): Path to the output video file.
             metadata (dict): Dictionary of metadata key/value pairs.
                              Example: {"title": "My Video", "artist": "Me", "comment": "Test"}
+            keep_backup (bool): Keep the original as OLD_<name> when remuxing (see swap_in).
 
         Returns:
             bool: True if successful, False otherwise.
         """
         input_path = Path(input_file)
-        temp_file_name = VideoReProcess._random_filename()
-        temp_output_file = f"/tmp/meta_{temp_file_name}"
+        # Written next to the source under a name derived from it, so a crashed run's leftover is overwritten
+        temp_output_file = f"{input_path.parent}/META_{ReprocessCheckpoint.temp_file_name(input_file)}"
+
+        undo_file = f"{input_path.parent}/META_{ReprocessCheckpoint._key(input_file)}.undo"
+
+        def roll_back(undo: Optional[dict] = None) -> None:
+            """Put back the bytes of an unverified retag, from `undo` or the sidecar."""
+            if undo is None and not os.path.exists(undo_file):
+                return
+            Mp4MetadataEditor.restore(input_file, undo or Mp4MetadataEditor.load_undo(undo_file))
+            os.remove(undo_file)
 
         if not input_path.exists():
             print(f"Error: File not found - {input_file}")
             return False
 
+        if os.path.exists(undo_file):
+            print(f"[WARN] Rolling back an interrupted retag of {input_file}")
+            roll_back()
+
+        # Both paths copy every stream, so the output must have the source's
+        source_streams = VideoReProcess.stream_counts(input_file)
+        undo = None
+        if input_path.suffix.lower() in (".mp4", ".m4v") and set(metadata) <= set(Mp4MetadataEditor.ILST_TAGS):
+            try:
+                undo = Mp4MetadataEditor.write_tags(
+                    input_file, metadata, save_undo=lambda record: Mp4MetadataEditor.save_undo(undo_file, record))
+            except (OSError, ValueError) as e:
+                print(f"[WARN] In-place retag of {input_file} failed, remuxing: {e}")
+                roll_back()
+        if undo is not None:
+            is_valid, error, _ = VideoReProcess._check_container(input_file, streams=source_streams)
+            if is_valid:
+                os.remove(undo_file)
+                return True
+            print(f"[WARN] In-place retag of {input_file} did not verify, remuxing: {error}")
+            roll_back(undo)
+
         # Build ffmpeg command
         cmd = [
             "ffmpeg", "-y",
@@ -453,126 +1645,540 @@ class VideoReProcess:
         try:
             subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-            shutil.copy2(temp_output_file, f"{input_path.parent}/{temp_file_name}")
-            if VideoReProcess.check_video(f"{input_path.parent}/{temp_file_name}"):
-                os.rename(input_path, f"{input_path.parent}/OLD_{input_path.name}")
-                os.rename(f"{input_path.parent}/{temp_file_name}", input_file)
-                os.remove(temp_output_file)
+            is_valid, _ = VideoReProcess.check_video(temp_output_file, streams=source_streams)
+            if is_valid:
+                VideoReProcess.swap_in(temp_output_file, input_file, keep_backup)
                 return True
             else:
                 print(f"[ERROR] Processed file for {str(input_path)} is corrupt and will not be moved.")
-                os.remove(temp_output_file)
-                os.remove(f"{input_path.parent}/{temp_file_name}")
                 return False
 
         except subprocess.CalledProcessError as e:
             print("FFmpeg error:", e.stderr.decode())
-            # Clean up temp file if it was created
+            return False
+
+        finally:
+            # Gone after a successful swap; otherwise a failed or partial output
             if os.path.exists(temp_output_file):
                 try:
                     os.remove(temp_output_file)
-                    print(f"Deleted temp file: {temp_output_file}")
                 except OSError as cleanup_err:
                     print(f"Failed to delete temp file: {cleanup_err}")
 
-            return False
-
     @staticmethod
-    def check_video(file_path: str) -> tuple[bool, str | None]:
+    def check_video(file_path: str, duration: Optional[float] = None, on_progress=None, should_stop=None,
+                    full: bool = False, samples: int = 4, sample_length: float = 2.0,
+                    streams: Optional[dict[str, int]] = None) -> tuple[bool, str | None]:
         """
-        Returns (True, None) if the video decodes without errors.
-        Returns (False, error_message) if corrupt or ffmpeg fails.
+        Tiered integrity check, cheapest first:
+          1. container: ffprobe opens it (moov present), it has a video stream and a
+             sane duration (matching `duration` when given), and the video/audio
+             stream counts match `streams` (see stream_counts) when given
+          2. decode the head, the tail and `samples` random spots of `sample_length` seconds
+          3. full decode, only with `full=True` or when tier 2 reports errors
+
+        Returns (True, None) if the video passes.
+        Returns (False, error_message) if corrupt, ffmpeg fails or the check is aborted.
         """
         try:
-            result = subprocess.run(
-                ["ffmpeg", "-v", "error", "-i", file_path, "-f", "null", "-"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            if result.stderr.strip():
-                # Return False + the error string
-                return False, result.stderr.strip()
-            return True, None
+            is_valid, error, probed = VideoReProcess._check_container(file_path, duration, streams)
+            if not is_valid:
+                return False, error
+            if not full:
+                errors = VideoReProcess._check_samples(file_path, probed, samples, sample_length, should_stop)
+                if should_stop is not None and should_stop():
+                    return False, "check aborted"
+                if not errors:
+                    return True, None
+                print(f"[WARN] Sampled check of {file_path} found errors, running full decode")
+            return VideoReProcess._check_full(file_path, duration or probed, on_progress, should_stop)
         except Exception as e:
             return False, str(e)
 
     @staticmethod
-    def reprocess(input_file: str, metadata: dict[str, str]) -> Optional[bool]:
+    def stream_counts(file_path: str) -> Optional[dict[str, int]]:
+        """Number of video and audio streams in `file_path`, from ffprobe; None if it can't be probed."""
+        try:
+            streams = VideoReProcess.get_metadata(file_path).get("streams", [])
+        except ValueError:
+            return None
+        return {kind: sum(stream.get("codec_type") == kind for stream in streams) for kind in ("video", "audio")}
+
+    @staticmethod
+    def _check_container(file_path: str, duration: Optional[float] = None,
+                         streams: Optional[dict[str, int]] = None) -> tuple[bool, str | None, float]:
+        """Tier 1 of check_video: (is_valid, error, probed_duration) from ffprobe alone.
+        `streams` is the expected stream_counts, e.g. the source's for a stream copy."""
+        cmd = ["ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", file_path]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            return False, result.stderr.strip() or "ffprobe failed", 0.0
+
+        info = json.loads(result.stdout)
+        found = {kind: sum(stream.get("codec_type") == kind for stream in info.get("streams", []))
+                 for kind in ("video", "audio")}
+        if not found["video"]:
+            return False, "no video stream", 0.0
+        if streams is not None and found != streams:
+            return False, f"{found['video']} video/{found['audio']} audio streams, expected " \
+                          f"{streams['video']}/{streams['audio']}", 0.0
+        probed = float(info.get("format", {}).get("duration", 0) or 0)
+        if probed <= 0:
+            return False, "missing duration", 0.0
+        if duration and abs(probed - duration) > max(2.0, duration * 0.01):
+            return False, f"duration {probed:.2f}s, expected {duration:.2f}s", probed
+        return True, None, probed
+
+    @staticmethod
+    def _check_samples(file_path: str, duration: float, samples: int, sample_length: float,
+                       should_stop=None) -> list[str]:
+        """Tier 2 of check_video: decode errors from the head, the tail and random spots."""
+        last_start = max(0.0, duration - sample_length)
+        starts = [0.0, last_start] + [random.uniform(0, last_start) for _ in range(samples)]
+
+        def decode(start):
+            runner = FFmpegRunner(["ffmpeg", "-v", "error", "-ss", f"{start:.3f}", "-i", file_path,
+                                   "-t", str(sample_length), "-f", "null", "-"], should_stop=should_stop)
+            lines = [line.strip() for line in runner.lines()]
+            if runner.returncode and not runner.aborted and not lines:
+                lines = [f"ffmpeg exited with {runner.returncode} at {start:.1f}s"]
+            return lines
+
+        with ThreadPoolExecutor(max_workers=len(starts)) as pool:
+            errors = [line for lines in pool.map(decode, starts) for line in lines]
+        return errors[:20]
+
+    @staticmethod
+    def _check_full(file_path: str, duration: Optional[float] = None, on_progress=None,
+                    should_stop=None) -> tuple[bool, str | None]:
+        """Tier 3 of check_video: decode the whole file."""
+        runner = FFmpegRunner(
+            ["ffmpeg", "-v", "error", "-i", file_path, "-f", "null", "-"],
+            duration=duration, on_progress=on_progress, should_stop=should_stop
+        )
+        errors = []
+        for line in runner.lines():
+            # Only keep the first few errors; one is enough to reject the file
+            if len(errors) < 20:
+                errors.append(line.strip())
+        if runner.aborted:
+            return False, "check aborted"
+        if errors:
+            # Return False + the error string
+            return False, "\n".join(errors)
+        return True, None
+
+    @staticmethod
+    def _most_common_crop(lines) -> tuple[Optional[str], int]:
+        """Most frequent cropdetect value in ffmpeg stderr lines, with its count."""
+        counter = {}
+        for line in lines:
+            match = re.search(r'crop=(\d+:\d+:\d+:\d+)', line)
+            if match:
+                crop_str = match.group(1)
+                counter[crop_str] = counter.get(crop_str, 0) + 1
+        if not counter:
+            return None, 0
+        crop_values = max(counter, key=counter.get)
+        return crop_values, counter[crop_values]
+
+    @staticmethod
+    def _parse_loudnorm(lines) -> Optional[dict]:
+        """Measurement JSON printed by loudnorm=...:print_format=json, or None."""
+        block = None
+        for line in lines:
+            if "Parsed_loudnorm" in line:
+                block = []
+            elif block is not None:
+                block.append(line)
+                if line.strip() == "}":
+                    break
+        try:
+            return json.loads("".join(block)) if block else None
+        except ValueError:
+            return None
+
+    @staticmethod
+    def measure_loudnorm(input_file: str, duration: Optional[float] = None, on_progress=None,
+                         should_stop=None) -> Optional[dict]:
+        """First loudnorm pass over the audio only (no video decode). Returns the measurement or None."""
+        cmd = ['ffmpeg', '-i', input_file, '-vn', '-map', '0:a:0',
+               '-af', f'loudnorm={VideoReProcess.LOUDNORM_TARGET}:print_format=json', '-f', 'null', '-']
+        runner = FFmpegRunner(cmd, duration=duration, on_progress=on_progress, should_stop=should_stop)
+        loudness = VideoReProcess._parse_loudnorm(runner.lines())
+        return None if runner.aborted else loudness
+
+    @staticmethod
+    def loudnorm_filter(loudness: Optional[dict]) -> str:
         """
-        Transcode video with automatic bar cropping based on detected crop values.
-        Produces a temporary `.build.mp4`, then renames it back to `input_file`.
+        Second loudnorm pass: linear normalization from a measurement. Falls back to
+        single-pass dynamic loudnorm without usable stats (e.g. silent audio).
         """
         try:
-            a = urlparse(input_file)
-            file = Path(os.path.basename(a.path))
-            filename = str(file.with_suffix(''))  # base name without extension
-            parent_path = Path(input_file).parent
+            values = {key: float(loudness[key]) for key in
+                      ("input_i", "input_tp", "input_lra", "input_thresh", "target_offset")}
+        except (TypeError, KeyError, ValueError):
+            values = None
+        if not values or not all(math.isfinite(v) for v in values.values()):
+            return f'loudnorm={VideoReProcess.LOUDNORM_TARGET}'
+        return (f'loudnorm={VideoReProcess.LOUDNORM_TARGET}'
+                f':measured_I={values["input_i"]}:measured_TP={values["input_tp"]}'
+                f':measured_LRA={values["input_lra"]}:measured_thresh={values["input_thresh"]}'
+                f':offset={values["target_offset"]}:linear=true')
 
-            # Step 1: detect crop values
-            cropdetect_cmd = ['ffmpeg', '-i', input_file, '-vf', 'cropdetect', '-f', 'null', '-']
-            result = subprocess.run(cropdetect_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-            counter = {}
-            for line in result.stderr.splitlines():
-                match = re.search(r'crop=(\d+:\d+:\d+:\d+)', line)
-                if match:
-                    crop_str = match.group(1)
-                    hash_str = hashlib.md5(crop_str.encode()).hexdigest()
-                    counter[hash_str] = counter.get(hash_str, []) + [crop_str]
-
-            if not counter:
-                raise RuntimeError("No crop values detected.")
-
-            largest_list_key = max(counter, key=lambda k: len(counter[k]))
-            crop_values = counter[largest_list_key].pop()
-
-            # Step 2: define temporary output
-            # temp_output_file = f"{parent_path}/{filename}.build.mp4"
-            temp_file_name = VideoReProcess._random_filename()
-            temp_output_file = f"/tmp/reprocess_{temp_file_name}"
-
-            # Step 3: run ffmpeg crop + transcode
-            crop_cmd = [
-                'ffmpeg', '-y', '-loglevel', 'quiet', '-i', input_file,
-                '-r', '30',
-                "-map_metadata", "-1",
-                '-vf', f'crop={crop_values},scale=min(512,iw):-2'
-                '-af', 'loudnorm=I=-26:TP=-2:LRA=7',
-                '-b:v', '800k',
-                '-c:v', 'h264_videotoolbox',
-                '-c:a', 'aac',
-                '-b:a', '128k',
-            ]
+    @staticmethod
+    def detect_crop(input_file: str, samples: int = 8, sample_length: float = 10.0, min_agreement: float = 0.6,
+                    measure_loudness: bool = False, on_progress=None,
+                    should_stop=None) -> tuple[Optional[str], Optional[float], Optional[dict]]:
+        """
+        Detect the crop for black bars from `samples` short cropdetect runs, input-seeked
+        across the middle 90% of the file and run in parallel. Each sample votes for its
+        most common crop; the winner needs `min_agreement` of the samples, otherwise
+        (or for short files) the whole file is scanned as before.
 
-            # Add metadata key/values
-            for k, v in metadata.items():
-                crop_cmd.extend(["-metadata", f"{k}={v}"])
+        With `measure_loudness`, the loudnorm measurement rides along in the full scan's
+        decode; when the samples are enough it comes from an audio-only decode instead.
 
-            crop_cmd.append(str(temp_output_file))
+        Returns:
+            (crop_values, duration, loudness); crop_values is None if nothing was detected
+            or `should_stop` aborted the scan, loudness is None unless measured.
+        """
+        metadata = VideoReProcess.get_metadata(input_file)
+        duration = float(metadata.get("format", {}).get("duration", 0) or 0) or None
+
+        if duration and duration > samples * sample_length * 2:
+            starts = [duration * (0.05 + 0.9 * (i + 0.5) / samples) for i in range(samples)]
+
+            def sample_crop(start):
+                cmd = ['ffmpeg', '-ss', f'{start:.3f}', '-i', input_file, '-t', str(sample_length),
+                       '-map', '0:v:0', '-vf', 'cropdetect', '-f', 'null', '-']
+                return VideoReProcess._most_common_crop(FFmpegRunner(cmd, should_stop=should_stop).lines())[0]
+
+            with ThreadPoolExecutor(max_workers=samples) as pool:
+                votes = [crop for crop in pool.map(sample_crop, starts) if crop]
+
+            if should_stop is not None and should_stop():
+                return None, duration, None
+            if votes:
+                crop_values = max(set(votes), key=votes.count)
+                if votes.count(crop_values) >= samples * min_agreement:
+                    loudness = None
+                    if measure_loudness:
+                        loudness = VideoReProcess.measure_loudnorm(input_file, duration, on_progress, should_stop)
+                    return crop_values, duration, loudness
+            print(f"[WARN] Crop samples disagree ({votes}), scanning full file: {input_file}")
+
+        cmd = ['ffmpeg', '-i', input_file, '-vf', 'cropdetect']
+        if measure_loudness:
+            cmd += ['-af', f'loudnorm={VideoReProcess.LOUDNORM_TARGET}:print_format=json']
+        runner = FFmpegRunner(cmd + ['-f', 'null', '-'], duration=duration, on_progress=on_progress,
+                              should_stop=should_stop)
+        lines = list(runner.lines())
+        if runner.aborted:
+            return None, duration, None
+        crop_values, _ = VideoReProcess._most_common_crop(lines)
+        loudness = VideoReProcess._parse_loudnorm(lines) if measure_loudness else None
+        return crop_values, duration or runner.duration, loudness
 
-            subprocess.run(crop_cmd, check=True)
+    @staticmethod
+    def keyframe_chunks(input_file: str, chunk_length: float = 600.0) -> list[tuple[float, float]]:
+        """
+        Split the file into (start, length) chunks of roughly `chunk_length` seconds that
+        each start on a video keyframe, so they can be encoded independently. Keyframes
+        come from the packet flags (demux only, nothing is decoded).
+        """
+        metadata = VideoReProcess.get_metadata(input_file)
+        duration = float(metadata["format"]["duration"])
+        start_time = float(metadata["format"].get("start_time", 0) or 0)
 
-            # Copy the file to the destination
+        cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags",
+               "-of", "csv=p=0", input_file]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        keyframes = []
+        for line in result.stdout.splitlines():
+            pts, _, flags = line.partition(",")
+            if "K" in flags and pts not in ("", "N/A"):
+                keyframes.append(float(pts) - start_time)
+        keyframes.sort()
+
+        starts = [0.0]
+        target = chunk_length
+        while keyframes and target < duration - chunk_length / 2:
+            index = bisect_left(keyframes, target)
+            nearest = min(keyframes[max(0, index - 1):index + 1], key=lambda k: abs(k - target))
+            if nearest - starts[-1] >= chunk_length / 2:
+                starts.append(nearest)
+            target += chunk_length
+        return [(start, end - start) for start, end in zip(starts, starts[1:] + [duration])]
 
-            shutil.copy2(temp_output_file, f"{parent_path}/{temp_file_name}")
-            if VideoReProcess.check_video(f"{parent_path}/{temp_file_name}"):
-                os.rename(input_file, f"{parent_path}/OLD_{file}")
-                os.rename(f"{parent_path}/{temp_file_name}", input_file)
-                os.remove(temp_output_file)
-                return True
-            else:
-                print(f"[ERROR] Processed file for {input_file} is corrupt and will not be moved.")
-                os.remove(temp_output_file)
-                os.remove(f"{parent_path}/{temp_file_name}")
+    @staticmethod
+    def transcode_chunked(input_file: str, output_file: str, video_args: list, audio_args: list, output_args: list,
+                          workers: int, chunk_length: float = 600.0, on_progress=None,
+                          should_stop=None) -> Optional[bool]:
+        """
+        Transcode the video as keyframe-aligned chunks on `workers` parallel ffmpeg
+        processes, with the audio encoded once alongside them, then join the chunks
+        losslessly with the concat demuxer and mux in the audio and `output_args`
+        (metadata). Every chunk gets the same `video_args`, so crop, scale and bitrate
+        match across the joins. Audio stays one stream to avoid AAC priming gaps at
+        chunk boundaries.
+
+        Chunk lengths are rounded to whole frames, so before joining the summed video
+        duration is checked against the audio; past CHUNKED_MAX_DRIFT the chunks are
+        dropped rather than muxed out of sync.
+
+        Returns:
+            True if `output_file` was written, False on failure or abort, None if the
+            chunks drifted from the audio (encode the file in one pass instead).
+        """
+        chunks = VideoReProcess.keyframe_chunks(input_file, chunk_length)
+        total_length = sum(length for _, length in chunks)
+        work_dir = tempfile.mkdtemp(prefix="reprocess_chunks_")
+        covered = {}
+        lock = threading.Lock()
+
+        def chunk_progress(index: int, length: float):
+            if on_progress is None:
+                return None
+
+            def report(progress: dict) -> None:
+                with lock:
+                    covered[index] = min(progress["out_time"], length)
+                    on_progress({
+                        "percent": round(min(100.0, sum(covered.values()) / total_length * 100), 1),
+                        "eta": None,
+                        "fps": progress["fps"],
+                        "speed": progress["speed"],
+                        "out_time": round(sum(covered.values()), 2),
+                        "chunks": len(chunks),
+                    })
+            return report
+
+        def encode(cmd, duration, progress=None) -> bool:
+            runner = FFmpegRunner(cmd, duration=duration, on_progress=progress, should_stop=should_stop)
+            runner.run()
+            return not runner.aborted and runner.returncode == 0
+
+        try:
+            chunk_files = [f"{work_dir}/chunk_{i:03d}.mp4" for i in range(len(chunks))]
+            # Without an audio track there is nothing to encode or mux (ffmpeg refuses an output with no streams)
+            source_streams = VideoReProcess.stream_counts(input_file)
+            audio_file = f"{work_dir}/audio.m4a" if source_streams is None or source_streams["audio"] else None
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                audio = None
+                if audio_file:
+                    audio = pool.submit(encode, ['ffmpeg', '-y', '-loglevel', 'quiet', '-i', input_file,
+                                                 '-map', '0:a:0?', '-vn', *audio_args, audio_file], total_length)
+                futures = [
+                    pool.submit(encode, ['ffmpeg', '-y', '-loglevel', 'quiet', '-ss', f'{start:.6f}',
+                                         '-i', input_file, '-t', f'{length:.6f}', '-map', '0:v:0', '-an',
+                                         *video_args, chunk_file], length, chunk_progress(i, length))
+                    for i, ((start, length), chunk_file) in enumerate(zip(chunks, chunk_files))
+                ]
+                encoded = [future.result() for future in futures] + [audio.result() if audio else True]
+            if not all(encoded):
+                print(f"[ERROR] Chunked transcode failed for {input_file}")
                 return False
 
+            if audio_file:
+                video_length = sum(VideoReProcess.probe_duration(chunk_file) for chunk_file in chunk_files)
+                audio_length = VideoReProcess.probe_duration(audio_file)
+                if abs(video_length - audio_length) > VideoReProcess.CHUNKED_MAX_DRIFT:
+                    print(f"[WARN] Chunks of {input_file} run {video_length:.2f}s against "
+                          f"{audio_length:.2f}s of audio")
+                    return None
+
+            concat_list = f"{work_dir}/chunks.txt"
+            with open(concat_list, "w") as f:
+                f.writelines(f"file '{chunk_file}'\n" for chunk_file in chunk_files)
+
+            join_cmd = ['ffmpeg', '-y', '-loglevel', 'quiet', '-f', 'concat', '-safe', '0', '-i', concat_list]
+            if audio_file:
+                join_cmd += ['-i', audio_file, '-map', '0:v', '-map', '1:a']
+            join_cmd += ['-c', 'copy', *output_args, output_file]
+            return encode(join_cmd, total_length)
+
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    @staticmethod
+    def reprocess(input_file: str, metadata: dict[str, str], on_progress=None, should_stop=None,
+                  chunk_workers: int = 1, keep_backup: bool = True) -> Optional[bool]:
+        """
+        Transcode video with automatic bar cropping based on detected crop values.
+        Encodes into a temp file next to `input_file`, verifies it, then swaps it in
+        with swap_in (the original is kept as OLD_ when `keep_backup`).
+        Files of CHUNKED_MIN_DURATION or longer are encoded in keyframe chunks on
+        `chunk_workers` parallel ffmpeg processes (see transcode_chunked), falling
+        back to one pass if the chunks drift from the audio.
+
+        Each finished stage (analysis, encode, verify) is recorded with
+        ReprocessCheckpoint, and temp files are named after the source path, so a
+        redelivered task resumes where the last attempt stopped instead of starting over.
+        The source is locked for the whole run (ReprocessCheckpoint.lock); if another
+        worker holds it, False is returned without touching anything.
+
+        `on_progress` receives the FFmpegRunner progress dict with a "stage" key
+        added (analysis, encode, verify). If `should_stop` aborts a stage the
+        source file is left untouched and False is returned.
+        """
+        def stage_progress(stage):
+            if on_progress is None:
+                return None
+            return lambda progress: on_progress({"stage": stage, **progress})
+
+        try:
+            parent_path = Path(input_file).parent
+
+            # Held until the swap, so a redelivered copy on another host can't encode the same source
+            with ReprocessCheckpoint.lock(input_file):
+                # Encode straight into the destination directory under a deterministic name,
+                # so a retry finds the previous attempt's output and the swap is a same-filesystem rename
+                temp_file_name = ReprocessCheckpoint.temp_file_name(input_file)
+                dest_temp_file = f"{parent_path}/{temp_file_name}"
+
+                def swap() -> None:
+                    """swap_in, recording the backup so a resumed swap never backs up the encoded file."""
+                    def backed_up() -> None:
+                        state["backup_done"] = True
+                        ReprocessCheckpoint.save(input_file, state)
+                    VideoReProcess.swap_in(dest_temp_file, input_file, keep_backup,
+                                           backup_done=state.get("backup_done", False), on_backup=backed_up)
+
+                state = ReprocessCheckpoint.load(input_file)
+                if state.get("stage") in ("verify", "swapped") and ReprocessCheckpoint.file_matches(
+                        dest_temp_file, state.get("encoded_size")):
+                    # Died before the swap: the output is verified, finish it
+                    swap()
+                    ReprocessCheckpoint.clear(input_file)
+                    return True
+                if state.get("stage") == "swapped" and os.path.exists(input_file) \
+                        and AnalysisCache.file_identity(input_file) == state.get("encoded"):
+                    # Died after the swap: the source already is the encoded file
+                    ReprocessCheckpoint.clear(input_file)
+                    return True
+
+                source = AnalysisCache.file_identity(input_file)
+                if state.get("source") != source:
+                    # No checkpoint, or one for a different version of the file: start clean
+                    ReprocessCheckpoint.clear(input_file)
+                    state = {"source": source, "input_file": input_file}
+
+                # Step 1: detect crop values and measure loudness (cached per source file, so retries skip them)
+                if "crop" not in state:
+                    crop_params = {"samples": 8, "sample_length": 10.0, "min_agreement": 0.6}
+                    loudness_params = {"target": VideoReProcess.LOUDNORM_TARGET}
+                    cached_crop = AnalysisCache.get(input_file, "crop", crop_params)
+                    # {} is a cached "no measurement" (silent or unmeasurable audio), None a cache miss
+                    loudness = AnalysisCache.get(input_file, "loudness", loudness_params)
+                    measure_loudness = loudness is None
+                    if cached_crop:
+                        crop_values, duration = cached_crop["crop"], cached_crop["duration"]
+                        if measure_loudness:
+                            loudness = VideoReProcess.measure_loudnorm(input_file, duration, stage_progress("analysis"),
+                                                                       should_stop)
+                    else:
+                        crop_values, duration, measured = VideoReProcess.detect_crop(
+                            input_file, **crop_params, measure_loudness=measure_loudness,
+                            on_progress=stage_progress("analysis"), should_stop=should_stop)
+                        if measure_loudness:
+                            loudness = measured
+                        if crop_values:
+                            AnalysisCache.put(input_file, "crop", crop_params, {"crop": crop_values, "duration": duration})
+
+                    if should_stop is not None and should_stop():
+                        print(f"[WARN] reprocess aborted during analysis: {input_file}")
+                        return False
+
+                    if not crop_values:
+                        raise RuntimeError("No crop values detected.")
+                    if measure_loudness:
+                        AnalysisCache.put(input_file, "loudness", loudness_params, loudness or {})
+                    loudness = loudness or None
+                    state.update(stage="analysis", crop=crop_values, duration=duration, loudness=loudness)
+                    ReprocessCheckpoint.save(input_file, state)
+
+                crop_values, duration, loudness = state["crop"], state["duration"], state["loudness"]
+
+                # Step 2: encode, unless a previous attempt already finished it
+                if not ReprocessCheckpoint.file_matches(dest_temp_file, state.get("encoded_size")):
+                    # Long files are encoded as parallel keyframe chunks
+                    video_args = [
+                        '-r', '30',
+                        '-vf', f'crop={crop_values},scale=min(512,iw):-2',
+                        '-b:v', '800k',
+                        '-c:v', 'h264_videotoolbox',
+                    ]
+                    audio_args = [
+                        '-af', VideoReProcess.loudnorm_filter(loudness),
+                        '-c:a', 'aac',
+                        '-b:a', '128k',
+                    ]
+                    output_args = ["-map_metadata", "-1"]
+
+                    # Add metadata key/values
+                    for k, v in metadata.items():
+                        output_args.extend(["-metadata", f"{k}={v}"])
+
+                    encoded = None
+                    if chunk_workers > 1 and duration and duration >= VideoReProcess.CHUNKED_MIN_DURATION:
+                        encoded = VideoReProcess.transcode_chunked(input_file, dest_temp_file, video_args,
+                                                                   audio_args, output_args, chunk_workers,
+                                                                   on_progress=stage_progress("encode"),
+                                                                   should_stop=should_stop)
+                    # None: the chunks drifted from the audio, so encode in one pass
+                    if encoded is None:
+                        crop_cmd = ['ffmpeg', '-y', '-loglevel', 'quiet', '-i', input_file,
+                                    *video_args, *audio_args, *output_args, dest_temp_file]
+                        runner = FFmpegRunner(crop_cmd, duration=duration, on_progress=stage_progress("encode"),
+                                              should_stop=should_stop)
+                        runner.run()
+                        encoded = not runner.aborted and runner.returncode == 0
+
+                    if not encoded:
+                        aborted = should_stop is not None and should_stop()
+                        print(f"[ERROR] Transcode {'aborted' if aborted else 'failed'} for {input_file}")
+                        if os.path.exists(dest_temp_file):
+                            os.remove(dest_temp_file)
+                        return False
+
+                    state.update(stage="encode", encoded_size=os.path.getsize(dest_temp_file))
+                    ReprocessCheckpoint.save(input_file, state)
+
+                # Step 3: verify, then swap it in for the source
+                if state["stage"] not in ("verify", "swapped"):
+                    # The encode keeps the first video and the first audio stream
+                    source_streams = VideoReProcess.stream_counts(input_file)
+                    expected_streams = source_streams and {"video": 1, "audio": min(1, source_streams["audio"])}
+                    is_valid, error = VideoReProcess.check_video(dest_temp_file, duration=duration,
+                                                                 streams=expected_streams,
+                                                                 on_progress=stage_progress("verify"),
+                                                                 should_stop=should_stop)
+                    if not is_valid:
+                        if should_stop is not None and should_stop():
+                            print(f"[WARN] reprocess aborted during verification: {input_file}")
+                            return False
+                        print(f"[ERROR] Processed file for {input_file} is corrupt and will not be moved: {error}")
+                        ReprocessCheckpoint.clear(input_file)
+                        return False
+                    state.update(stage="verify")
+                    ReprocessCheckpoint.save(input_file, state)
+
+                # Recorded before the swap, so a retry can tell an already swapped source from a new one
+                state.update(stage="swapped", encoded=AnalysisCache.file_identity(dest_temp_file))
+                ReprocessCheckpoint.save(input_file, state)
+                swap()
+                ReprocessCheckpoint.clear(input_file)
+                return True
+
+        except BlockingIOError:
+            print(f"[WARN] {input_file} is already being reprocessed by another worker")
+            return False
         except Exception as e:
             print(f"[ERROR] process_remove_bars failed: {e}")
             return None
 
 
-
 """
 Module: video_contact_sheet
 ---------------------------
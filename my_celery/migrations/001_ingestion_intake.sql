@@ -0,0 +1,23 @@
+-- Intake support for ingestion_tasks (celery_ingestion.py). Run once:
+--   psql -f migrations/001_ingestion_intake.sql
+BEGIN;
+
+-- Claimed rows are heartbeated by their intake and remember the Celery task they were submitted as
+ALTER TABLE ingestion_tasks ADD COLUMN IF NOT EXISTS heartbeat_at timestamptz;
+ALTER TABLE ingestion_tasks ADD COLUMN IF NOT EXISTS celery_id text;
+
+-- Wake intakes on new pending rows; the channel is celery_ingestion.NOTIFY_CHANNEL
+CREATE OR REPLACE FUNCTION notify_ingestion_task() RETURNS trigger AS $$
+BEGIN
+    IF NEW.status = 'pending' THEN
+        PERFORM pg_notify('ingestion_tasks', NEW.task_id::text);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS ingestion_tasks_notify ON ingestion_tasks;
+CREATE TRIGGER ingestion_tasks_notify AFTER INSERT OR UPDATE OF status ON ingestion_tasks
+    FOR EACH ROW EXECUTE FUNCTION notify_ingestion_task();
+
+COMMIT;
@@ -0,0 +1,13 @@
+-- Remember which episodes break detection has run on, so ones with no breaks
+-- aren't rescanned by every backfill (backfill.py). Run once:
+--   psql -f migrations/002_breaks_scanned.sql
+BEGIN;
+
+ALTER TABLE episodes ADD COLUMN IF NOT EXISTS breaks_scanned_at timestamptz;
+
+-- Episodes that already have breaks were scanned
+UPDATE episodes e SET breaks_scanned_at = now()
+WHERE e.breaks_scanned_at IS NULL
+  AND EXISTS (SELECT 1 FROM commercial_breaks cb WHERE cb.media_id = e.episode_id);
+
+COMMIT;
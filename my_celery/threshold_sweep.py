@@ -0,0 +1,99 @@
+"""
+Commercial break threshold sweep for one show.
+
+    python threshold_sweep.py --show-id 274 --tolerance 0.5 1 2
+
+Runs CommercialBreaks.run_ffmpeg_detect_raw once per episode at every black/silence
+level in the grid (one decode per episode) and caches the raw runs as JSON in --cache-dir.
+Every combination in the grid is then re-scored in memory against the cache, so
+trying another grid only re-reads the JSON files instead of re-decoding the show.
+
+Scoring uses --expected-breaks when given, otherwise the number of break positions
+the show's detection history agrees on (CommercialBreaks.get_break_priors).
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from backfill import get_missing
+from classes.video_utils import CommercialBreaks
+
+DEFAULT_GRID = {
+    "black_threshold": [0.05, 0.08, 0.1, 0.15],
+    "black_duration": [0.3, 0.5, 0.8, 1.2],
+    "db": [40, 50, 60],
+    "silence_duration": [0.1, 0.2, 0.5, 1.0],
+    "tolerance": [0.5, 1.0, 2.0],
+    "max_gap": [0.5, 1.0, 2.0],
+}
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Sweep commercial break detection thresholds for one show.")
+    parser.add_argument('--show-id', type=int, required=True, help='Show whose episodes are swept.')
+    parser.add_argument('--cache-dir', default="/tmp/threshold_sweep", help='Where raw detections are cached.')
+    parser.add_argument('--workers', type=int, default=4, help='Episodes decoded in parallel.')
+    parser.add_argument('--expected-breaks', type=int, default=None,
+                        help='Breaks per episode; defaults to what the show\'s break history agrees on.')
+    for key, values in DEFAULT_GRID.items():
+        parser.add_argument(f'--{key.replace("_", "-")}', dest=key, type=float, nargs='+', default=values,
+                            help=f'Grid values for {key}.')
+    return parser.parse_args()
+
+
+def load_raw(episode: dict, grid: dict, cache_dir: str) -> dict | None:
+    """Raw detections for an episode, from the cache or a fresh decode."""
+    cache_file = f"{cache_dir}/{episode['media_id']}.json"
+    if os.path.exists(cache_file):
+        with open(cache_file, "r") as f:
+            raw = json.load(f)
+        cached_levels = ({t for t, _ in raw["black"]}, {db for db, _ in raw["silence"]})
+        if set(grid["black_threshold"]) <= cached_levels[0] and set(grid["db"]) <= cached_levels[1]:
+            return raw
+
+    print(f"Detecting: {episode['path']}")
+    raw = CommercialBreaks.run_ffmpeg_detect_raw(episode['path'], grid["black_threshold"], grid["db"],
+                                                 silence_duration=min(grid["silence_duration"]))
+    if raw is not None:
+        with open(cache_file, "w") as f:
+            json.dump(raw, f)
+    return raw
+
+
+def main() -> None:
+    args = parse_arguments()
+    grid = {key: getattr(args, key) for key in DEFAULT_GRID}
+    os.makedirs(args.cache_dir, exist_ok=True)
+    episodes = get_missing("episodes", f"m.show_id = {args.show_id}")
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        raws = list(pool.map(lambda episode: load_raw(episode, grid, args.cache_dir), episodes))
+
+    sweep_input = [
+        {
+            "episode_id": episode['media_id'],
+            "raw": raw,
+            "start_point": float(episode['start_point'] or 0),
+            "end_point": float(episode['end_point']) if episode['end_point'] else None,
+        }
+        for episode, raw in zip(episodes, raws) if raw is not None
+    ]
+
+    expected_breaks = args.expected_breaks
+    if expected_breaks is None:
+        expected_breaks = len(CommercialBreaks.get_break_priors(args.show_id))
+    if not expected_breaks:
+        print("No break history for this show; pass --expected-breaks.")
+        return
+
+    results = CommercialBreaks.sweep_detection_params(sweep_input, grid, expected_breaks=expected_breaks)
+    print(f"\n{len(sweep_input)} episodes, {len(results)} combinations, {expected_breaks} expected breaks")
+    print(results.head(10))
+    print("\nBest parameters:")
+    print(results.iloc[0].to_dict())
+
+
+if __name__ == "__main__":
+    main()
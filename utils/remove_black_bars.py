@@ -1,30 +1,21 @@
-import hashlib
 import os
-import re
 import subprocess
+import sys
 from pathlib import Path
 from urllib.parse import urlparse
 
+# Run as `python utils/remove_black_bars.py`: make the repo root importable for my_celery
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from my_celery.classes.video_utils import VideoReProcess
+
 
 def process_remove_bars(input_file):
     a = urlparse(input_file)
     file = Path(os.path.basename(a.path))
     filename = str(file.with_suffix(''))
     parent_path = Path(input_file).parent
-    cropdetect_cmd = [
-        'ffmpeg', '-i', input_file, '-vf', 'cropdetect', '-f', 'null', '-'
-    ]
-    result = subprocess.run(cropdetect_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-    counter = {}
-    for line in result.stderr.splitlines():
-        match = re.search(r'crop=(\d+:\d+:\d+:\d+)', line)
-        if match:
-            hash_str = hashlib.md5(str(match.group(1)).encode()).hexdigest()
-            counter[hash_str] = counter.get(hash_str, []) + [match.group(1)]
-
-    largest_list_key = max(counter, key=lambda k: len(counter[k]))
-    crop_values = counter[largest_list_key].pop()
+    crop_values, _, loudness = VideoReProcess.detect_crop(input_file, measure_loudness=True)
 
     if crop_values:
         output_file = f"/tmp/{filename}.build.mp4"
@@ -32,7 +23,7 @@ def process_remove_bars(input_file):
             'ffmpeg', '-y', '-loglevel', 'quiet', '-i', input_file,
             '-r', '30',
             '-vf', f'crop={crop_values},scale=640:480,setdar=4/3',
-            '-af', 'loudnorm=I=-26:TP=-2:LRA=7',
+            '-af', VideoReProcess.loudnorm_filter(loudness),
             '-b:v', '500k',
             '-c:v', 'h264_videotoolbox',
             '-c:a', 'aac',